@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import math
 
 import numpy as np
-import scipy.stats
+
+# Likelihoods that underflow to 0 are reported as 1e-5 instead (see get_likelihood)
+_LOG_PDF_UNDERFLOW = math.log(np.nextafter(0, 1))
+_LOG_PDF_FLOOR = math.log(1e-5)
 
 
 @dataclass
@@ -83,7 +87,8 @@ class EKF:
         #p = dist.pdf(diff(z, zhat_mu))
 
         # Replace with the pdf expression because the scipy implementation is too slow.
-        p =np.exp(-1/2 * diff(z, self.zhat_mu).T @ self.inv_z_cov @ diff(z, self.zhat_mu))
+        d = diff(z, self.zhat_mu)
+        p = np.exp(-1/2 * (d @ self.inv_z_cov @ d))
         if normalize:
             p *= self.normalizing_factor
         if p == 0:
@@ -92,8 +97,19 @@ class EKF:
             return 1e-5
         return p
 
+    def get_log_likelihood(self, z, diff=lambda x, y: x - y, normalize=True):
+        """Natural log of get_likelihood, without going through exp."""
+        d = diff(z, self.zhat_mu)
+        log_p = -1/2 * (d @ self.inv_z_cov @ d)
+        if normalize:
+            log_p += math.log(self.normalizing_factor)
+        if log_p < _LOG_PDF_UNDERFLOW:
+            return _LOG_PDF_FLOOR
+        return log_p
+
     def get_Mahalanobis_squared(self, z, diff=lambda x, y: x - y):
-        return diff(z, self.zhat_mu).T @ self.inv_z_cov @ diff(z, self.zhat_mu)
+        d = diff(z, self.zhat_mu)
+        return d @ self.inv_z_cov @ d
 
 
     def get_mu(self) -> np.ndarray:
@@ -139,12 +155,22 @@ class EKF:
             self.zhat_mu = self.h(self.mu, self.parameters)
 
             self.z_cov = self.zhat_cov + self.Dhn @ self.Dhn.T
-            self.inv_z_cov = np.linalg.inv(self.z_cov)
-            self.normalizing_factor = np.linalg.det(2 * np.pi * self.z_cov)**(-1/2)
+            if self.z_cov.shape == (2, 2):
+                # Closed form: LAPACK call overhead dominates for 2x2 measurements
+                (a, b), (c, d) = self.z_cov.tolist()
+                # As a numpy scalar, a singular or indefinite z_cov gives inf/nan like np.linalg
+                # rather than raising or turning the normalizing factor complex
+                det = np.float64(a*d - b*c)
+                self.inv_z_cov = np.array([[d, -b], [-c, a]]) / det
+                self.normalizing_factor = (4 * np.pi**2 * det)**(-1/2)
+            else:
+                self.inv_z_cov = np.linalg.inv(self.z_cov)
+                self.normalizing_factor = np.linalg.det(2 * np.pi * self.z_cov)**(-1/2)
 
     def _check_cov(self):
         if(self.min_cov is not None):
             if(np.linalg.det(self.cov) < np.linalg.det(self.min_cov)):
-                self.cov += self.min_cov
+                # Not in place, the array may be shared with copies of this filter
+                self.cov = self.cov + self.min_cov
 
     
\ No newline at end of file
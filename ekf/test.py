@@ -20,10 +20,10 @@ def plot():
 
     # Plot ellipse
     est_ellipse.set_center(mu)
-    [w, v] = np.linalg.eig(cov)
+    w, v = np.linalg.eigh(cov)
     est_ellipse.set_width(np.sqrt(w[0])*n_stds*2)
     est_ellipse.set_height(np.sqrt(w[1])*n_stds*2)
-    angle_deg = math.atan2(v[1, 0], v[0, 0]) * 180/np.pi
+    angle_deg = math.degrees(math.atan2(v[1, 0], v[0, 0]))
     est_ellipse.set_angle(angle_deg)
 
     # Plot real position
@@ -77,7 +77,28 @@ def auto(N=500, T=1e-9, obs_p=0):
         plt.pause(T)
 
 
+def check_singular_z_cov():
+    """Singular and indefinite 2x2 innovation covariances must give real inf/nan
+    normalizing factors, as through np.linalg, rather than raise or go complex."""
+    import warnings
+
+    for z_cov in (np.zeros((2, 2)), np.array([[1., 2.], [2., 1.]])):
+        ekf = EKF(EKFSettings(mu0=np.zeros(2), cov0=z_cov, g=None, get_Dgx=None, get_Dgm=None))
+        ekf.set_sensor_model(lambda x, parameters: x, lambda x, parameters: np.eye(2),
+                             lambda x, parameters: np.zeros((2, 2)))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            ekf.set_parameters((np.zeros(2),))
+            log_likelihood = ekf.get_log_likelihood(np.ones(2))
+        assert isinstance(ekf.normalizing_factor, np.floating), type(ekf.normalizing_factor)
+        assert not np.iscomplexobj(log_likelihood)
+        print(f'z_cov det {np.linalg.det(z_cov):.1f}: normalizing factor {ekf.normalizing_factor}, '
+              f'log likelihood {log_likelihood}')
+
+
 if __name__ == "__main__":
+    check_singular_z_cov()
+
     rng = np.random.default_rng()
     # Initial position
     p = np.array([10, 0])
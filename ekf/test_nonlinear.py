@@ -23,10 +23,10 @@ def plot():
 
     # Plot ellipse
     est_ellipse.set_center(mu)
-    [w, v] = np.linalg.eig(cov)
+    w, v = np.linalg.eigh(cov)
     est_ellipse.set_width(np.sqrt(w[0])*n_stds*2)
     est_ellipse.set_height(np.sqrt(w[1])*n_stds*2)
-    angle_deg = math.atan2(v[1, 0], v[0, 0]) * 180/np.pi
+    angle_deg = math.degrees(math.atan2(v[1, 0], v[0, 0]))
     est_ellipse.set_angle(angle_deg)
 
     # Plot real position
@@ -1,6 +1,22 @@
 import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Fallback for numba.njit when numba is not installed: leaves the function as is."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda function: function
+
+
+_TWO_PI = 2*np.pi
+_INV_TWO_PI = 1/(2*np.pi)
+
+@njit(cache=True, fastmath=True)
+def wrap_angle(a):
+    """Wraps an angle (or array of angles) to [-pi, pi[, without branches or a modulo."""
+    return a - _TWO_PI*np.floor((a + np.pi)*_INV_TWO_PI)
 
 def R(theta):
     return np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
 
-
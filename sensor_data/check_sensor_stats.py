@@ -7,9 +7,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--file", type=str, default='sim0.xz')
 args = parser.parse_args()
 data = sd.load_sensor_data(args.file)
-to = np.array([k[0] for k in data.odometry])
+to = data.odometry_ts
 tc = np.array([k[0] for k in data.camera])
-tl = np.array([k[0] for k in data.lidar])
+tl = data.lidar_ts
 
 plt.figure()
 plt.scatter(np.arange(to.size - 1), 1e9/(np.diff(to)))
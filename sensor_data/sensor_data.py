@@ -1,18 +1,31 @@
 from __future__ import annotations
 import os
+import collections
 import pickle
 import lzma
 import hashlib
 import struct
-from dataclasses import dataclass, asdict, field
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 
 import numpy as np
 import cv2
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    from turbojpeg import TurboJPEG
+    _TURBOJPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # Missing either the python bindings or libturbojpeg itself
+    _TURBOJPEG = None
 
 import rosbags.rosbag1
 import rosbags.serde
 
 import usim.umap
+from math_extra import njit
 
 
 DEFAULT_SENSOR_DATA_DIR = os.path.join('data', 'sensor_data')
@@ -21,6 +34,35 @@ if not os.path.isdir('data'):
 if not os.path.isdir(DEFAULT_SENSOR_DATA_DIR):
     os.mkdir(DEFAULT_SENSOR_DATA_DIR)
 
+# Magic bytes at the start of each supported container, used to pick the
+# right decompressor when loading (older files were always written with lzma)
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+DEFAULT_COMPRESSION = 'lz4' if lz4 is not None else 'xz'
+# Files with these extensions are always written in the matching format
+COMPRESSION_EXTENSIONS = {'.lz4': 'lz4', '.xz': 'xz'}
+
+# Header of (decompressed) sensor data streams whose arrays are stored as
+# out-of-band pickle buffers. Older files hold a plain pickled dict of fields
+OOB_HEADER = b'SAUT-OOB'
+_UINT64 = struct.Struct('<Q')
+_CAMERA_FRAME_HEADER = struct.Struct('<qq')
+
+# Marker detection setup is the same for every frame, so build it only once.
+# OpenCV >= 4.7 replaced detectMarkers and DetectorParameters_create with ArucoDetector
+_ARUCO_DICT = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
+if hasattr(cv2.aruco, 'ArucoDetector'):
+    _ARUCO_PARAMS = cv2.aruco.DetectorParameters()
+    _ARUCO_DETECTOR = cv2.aruco.ArucoDetector(_ARUCO_DICT, _ARUCO_PARAMS)
+else:
+    _ARUCO_PARAMS = cv2.aruco.DetectorParameters_create()
+    _ARUCO_DETECTOR = None
+
+
+def shallow_asdict(obj) -> dict:
+    """Like dataclasses.asdict, but without recursing into (and deep-copying) the field values."""
+    return {f.name: getattr(obj, f.name) for f in fields(obj)}
+
 
 @dataclass
 class SimulationData:
@@ -30,11 +72,56 @@ class SimulationData:
     def __post_init__(self):
         if type(self.map) is dict:
             self.map = usim.umap.UsimMap(**self.map)
+        self.robot_pose = np.ascontiguousarray(self.robot_pose)
+
+    def __getstate__(self) -> dict:
+        return shallow_asdict(self)
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+
+class SensorStream:
+    """Timestamped samples of a single sensor, stored as parallel arrays.
+
+    Indexing and iterating behave like the list of (timestamp, values) tuples
+    this replaces, while `ts` (N,) and `values` (N, ...) give direct access to
+    the contiguous arrays.
+    """
+    def __init__(self, ts: np.ndarray, values: np.ndarray) -> None:
+        self.ts: np.ndarray = np.ascontiguousarray(ts, dtype=np.int64)
+        self.values: np.ndarray = np.ascontiguousarray(values)
+
+    @classmethod
+    def from_samples(cls, samples: list[tuple[int, np.ndarray]]) -> SensorStream:
+        """Build a stream from a list of (timestamp, values) tuples."""
+        if isinstance(samples, SensorStream):
+            return samples
+        if len(samples) == 0:
+            return cls(np.empty((0,), dtype=np.int64), np.empty((0,)))
+        ts = np.fromiter((t for t, _ in samples), dtype=np.int64, count=len(samples))
+        values = np.stack([arr for _, arr in samples])
+        return cls(ts, values)
+
+    def __len__(self) -> int:
+        return self.ts.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return SensorStream(self.ts[idx], self.values[idx])
+        return int(self.ts[idx]), self.values[idx]
+
+    def __iter__(self):
+        return zip(self.ts.tolist(), self.values)
+
+    def __repr__(self) -> str:
+        return f'SensorStream(len={len(self)}, values_shape={self.values.shape})'
+
 
 @dataclass
 class SensorData:
-    odometry: list[tuple[int, np.ndarray]]                  # (timestamp, [theta, x, y])
-    lidar: list[tuple[int, np.ndarray]]                     # (timestamp, [phi, r])
+    # list[tuple[int, np.ndarray]] are converted to SensorStream on construction
+    odometry: SensorStream                  # (timestamp, [theta, x, y])
+    lidar: SensorStream                     # (timestamp, [phi, r])
     # camera is: (timestamp, list[id, [phi, r]], CompressedImg)
     # decompress example: Img = cv2.imdecode(CompressedImg, cv2.IMREAD_COLOR)
     camera: list[tuple[int, list[tuple[int, np.ndarray]], np.ndarray]]
@@ -57,34 +144,72 @@ class SensorData:
     def __post_init__(self) -> None:
         if type(self.sim_data) is dict:
             self.sim_data = SimulationData(**self.sim_data)
+        self.odometry = SensorStream.from_samples(self.odometry)
+        self.lidar = SensorStream.from_samples(self.lidar)
+        self._freeze_arrays()
+        # Any hash passed in (e.g. by older files) may come from a different
+        # hashing scheme, so it is always recomputed lazily
+        self._hash_str = None
+
+    def __getstate__(self) -> dict:
+        state = shallow_asdict(self)
+        state['_hash_str'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._freeze_arrays()
+        self._hash_str = None
+
+    @property
+    def odometry_ts(self) -> np.ndarray:
+        return self.odometry.ts
+
+    @property
+    def odometry_vals(self) -> np.ndarray:
+        return self.odometry.values
+
+    @property
+    def lidar_ts(self) -> np.ndarray:
+        return self.lidar.ts
+
+    @property
+    def lidar_vals(self) -> np.ndarray:
+        return self.lidar.values
+
+    def _freeze_arrays(self) -> None:
+        """Make the sensor arrays read-only, since the cached hash depends on them."""
+        for stream in (self.odometry, self.lidar):
+            stream.ts.flags.writeable = False
+            stream.values.flags.writeable = False
+        for _, landmarks, _ in self.camera:
+            for _, arr in landmarks:
+                arr.flags.writeable = False
     
     def hash_str(self):
+        """SHA-256 hex digest of the sensor measurements, computed once and cached."""
         if self._hash_str is not None:
             return self._hash_str
-        hash_repr = hashlib.sha1(b"")
-        for t, arr in self.odometry:
-            arr.flags.writeable = False
-            tbytes =  bytearray(struct.pack("f", t))
-            arrbytes = arr.data
-            hash_repr.update(tbytes)
-            hash_repr.update(arrbytes)
-
-        for t, arr in self.lidar:
-            arr.flags.writeable = False
-            tbytes =  bytearray(struct.pack("f", t))
-            arrbytes = arr.data
-            hash_repr.update(tbytes)
-            hash_repr.update(arrbytes)
-        
+        hash_repr = hashlib.sha256(b"")
+        # Hash each stream as two large blocks (timestamps and values) rather
+        # than element by element
+        for stream in (self.odometry, self.lidar):
+            if not stream:
+                continue
+            # Timestamps are hashed as the full int64 nanoseconds (float32 would
+            # merge nearby timestamps)
+            hash_repr.update(stream.ts.data)
+            hash_repr.update(stream.values.data)
+
+        # Each camera frame as its timestamp and landmark count, then all of its ids
+        # and all of its measurements as one block each
+        pack_header = _CAMERA_FRAME_HEADER.pack
         for t, landmarks, compressed_image in self.camera:
-            tbytes =  bytearray(struct.pack("f", t))
-            hash_repr.update(tbytes)
-            for id, arr in landmarks:
-                idbytes =  bytearray(struct.pack("f", t))
-                hash_repr.update(idbytes)
-                arr.flags.writeable = False
-                arrbytes = arr.data
-                hash_repr.update(arrbytes)
+            hash_repr.update(pack_header(int(t), len(landmarks)))
+            if not landmarks:
+                continue
+            hash_repr.update(np.fromiter((id for id, _ in landmarks), dtype=np.int32, count=len(landmarks)).data)
+            hash_repr.update(np.concatenate([arr.ravel() for _, arr in landmarks]).astype(np.float64, copy=False).data)
 
         self._hash_str = hash_repr.hexdigest()
         return self._hash_str
@@ -93,48 +218,143 @@ class SensorData:
         return int(self.hash_str(), 16)
 
 
-def load_sensor_data(filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR) -> SensorData:
-    with lzma.open(os.path.join(dir, filename), 'rb') as f:
-        data_dict = pickle.load(f)
-    return SensorData(**data_dict)
+def _open_compressed(path: os.PathLike, mode: str, compression: str = None):
+    """Open a compressed file for reading or writing.
+
+    When reading, the compression format is detected from the file's magic
+    bytes, so `compression` is only relevant when writing. If not given, it is
+    the one matching the file's extension (see COMPRESSION_EXTENSIONS), or
+    DEFAULT_COMPRESSION for other extensions.
+    """
+    if 'r' in mode:
+        with open(path, 'rb') as f:
+            magic = f.read(max(len(LZ4_MAGIC), len(XZ_MAGIC)))
+        if magic.startswith(LZ4_MAGIC):
+            compression = 'lz4'
+        elif magic.startswith(XZ_MAGIC):
+            compression = 'xz'
+        else:
+            raise ValueError(f"Unknown compression format for file '{path}'")
+    elif compression is None:
+        compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower(), DEFAULT_COMPRESSION)
+    if compression == 'lz4':
+        if lz4 is None:
+            raise ImportError("The 'lz4' package is required for lz4 compressed sensor data")
+        return lz4.frame.open(path, mode, compression_level=0)
+    elif compression == 'xz':
+        return lzma.open(path, mode)
+    raise ValueError(f"Unknown compression '{compression}', expected one of 'lz4' or 'xz'")
+
+
+def _read_exact(f, n: int) -> bytearray:
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    read = 0
+    while read < n:
+        chunk = f.readinto(view[read:])
+        if not chunk:
+            raise EOFError("Sensor data file ended unexpectedly")
+        read += chunk
+    return buffer
 
 
-def save_sensor_data(sensor_data: SensorData, filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR) -> None:
-    data_dict = asdict(sensor_data)
-    with lzma.open(os.path.join(dir, filename), 'wb') as f:
-        pickle.dump(data_dict, f)
+def load_sensor_data(filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR) -> SensorData:
+    with _open_compressed(os.path.join(dir, filename), 'rb') as f:
+        header = f.read(len(OOB_HEADER))
+        if header != OOB_HEADER:
+            # Files written before out-of-band buffers were used
+            data_dict = pickle.loads(header + f.read())
+            return SensorData(**data_dict)
+        n_buffers, = _UINT64.unpack(f.read(_UINT64.size))
+        buffers = []
+        for _ in range(n_buffers):
+            nbytes, = _UINT64.unpack(f.read(_UINT64.size))
+            buffers.append(_read_exact(f, nbytes))
+        return pickle.Unpickler(f, buffers=buffers).load()
+
+
+def save_sensor_data(sensor_data: SensorData, filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR,
+                     compression: str = None) -> None:
+    """Save the sensor data to a file, compressed as given by its extension unless
+    `compression` ('lz4' or 'xz') is given.
+
+    Array buffers are handed over by pickle out-of-band and written directly
+    to the (compressed) file, ahead of the pickled object referencing them.
+    """
+    buffers: list[pickle.PickleBuffer] = []
+    payload = pickle.dumps(sensor_data, protocol=5, buffer_callback=buffers.append)
+    with _open_compressed(os.path.join(dir, filename), 'wb', compression) as f:
+        f.write(OOB_HEADER)
+        f.write(_UINT64.pack(len(buffers)))
+        for buffer in buffers:
+            raw = buffer.raw()
+            f.write(_UINT64.pack(raw.nbytes))
+            f.write(raw)
+        f.write(payload)
+
+
+def estimate_marker_poses(corners: list[np.ndarray], marker_length: float, camera_matrix: np.ndarray,
+                          distortion_coefficents) -> tuple[np.ndarray, np.ndarray]:
+    """Estimate the pose of every detected marker with respect to the camera.
+
+    Args:
+        corners: The (1, 4, 2) corner sets returned by the marker detector.
+        marker_length: Side length of the markers, in meters.
+
+    Returns:
+        (rotations, translations), both (N, 3) arrays, with the rotations given
+        as Rodrigues vectors.
+    """
+    if hasattr(cv2.aruco, 'estimatePoseSingleMarkers'):
+        # Takes all corner sets at once
+        rotations, translations, _ = cv2.aruco.estimatePoseSingleMarkers(
+            corners, marker_length, camera_matrix, distortion_coefficents)
+        return rotations.reshape((-1, 3)), translations.reshape((-1, 3))
+
+    # OpenCV >= 4.7 dropped estimatePoseSingleMarkers, so solve each marker directly with the
+    # same (iterative) method it used, which is stabler than IPPE for near frontal markers
+    half = marker_length / 2
+    object_points = np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]])
+    rotations = np.empty((len(corners), 3))
+    translations = np.empty((len(corners), 3))
+    for idx, cornerset in enumerate(corners):
+        _, rotation, translation = cv2.solvePnP(object_points, cornerset.reshape((4, 2)), camera_matrix,
+                                                distortion_coefficents)
+        rotations[idx] = rotation.ravel()
+        translations[idx] = translation.ravel()
+    return rotations, translations
 
 
 def detect_landmarks(image: np.ndarray, camera_matrix: np.ndarray, distortion_coefficents) -> list[tuple[int, float]]:
-    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
-    parameters = cv2.aruco.DetectorParameters_create()
-    corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(image, aruco_dict, parameters=parameters)
+    if _ARUCO_DETECTOR is not None:
+        corners, ids, rejectedImgPoints = _ARUCO_DETECTOR.detectMarkers(image)
+    else:
+        corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(image, _ARUCO_DICT, parameters=_ARUCO_PARAMS)
     if ids is None:
         return (image, [])
 
-    angles = []
-    distances = []
-    orientations = []
-    for cornerset in corners:
-        LA  = 0.083     # Physical size of the aruco markers. Should be an input parameter
-
-        # Estimate the position of the aruco markers in world coordinates
-        rotation, translation, _ = cv2.aruco.estimatePoseSingleMarkers(cornerset, LA, camera_matrix, distortion_coefficents)
-        translation = translation.squeeze()
-        rotation_matrix, _ = cv2.Rodrigues(rotation)
-        normal_vector = rotation_matrix @ np.array([0, 0, 1])
-        orientation = np.arctan2(normal_vector[2], normal_vector[0])
-
-        # Use the position of the markers to get the distance and difference in heading to the robot
-        distance = np.linalg.norm(translation)
-        angle = np.arctan(-translation[0]/translation[2])
-        angles.append(angle)
-        distances.append(distance)
-        orientations.append(orientation)
+    LA  = 0.083     # Physical size of the aruco markers. Should be an input parameter
+
+    # Estimate the position of the aruco markers in world coordinates
+    rotations, translations = estimate_marker_poses(corners, LA, camera_matrix, distortion_coefficents)
+
+    # Normal of each marker, the third column of its rotation matrix. By Rodrigues' formula,
+    # R @ e_z = cos(a)*e_z + sin(a)*(k x e_z) + (1 - cos(a))*k_z*k, with rotation vector a*k
+    rotation_angles = np.linalg.norm(rotations, axis=1)
+    axes = rotations / np.where(rotation_angles > 0, rotation_angles, 1)[:, None]
+    cos_a, sin_a = np.cos(rotation_angles), np.sin(rotation_angles)
+    normal_x = sin_a*axes[:, 1] + (1 - cos_a)*axes[:, 2]*axes[:, 0]
+    normal_z = cos_a + (1 - cos_a)*axes[:, 2]*axes[:, 2]
+    orientations = np.arctan2(normal_z, normal_x)
+
+    # Use the position of the markers to get the distance and difference in heading to the robot
+    distances = np.linalg.norm(translations, axis=1)
+    angles = np.arctan(-translations[:, 0]/translations[:, 2])
 
+    for cornerset, distance, angle in zip(corners, distances, angles):
         # Draw the aruco markers on the image
-        corners = cornerset.reshape((4, 2))
-        (topLeft, topRight, bottomRight, bottomLeft) = corners
+        marker_corners = cornerset.reshape((4, 2))
+        (topLeft, topRight, bottomRight, bottomLeft) = marker_corners
 		# convert each of the (x, y)-coordinate pairs to integers
         topRight = (int(topRight[0]), int(topRight[1]))
         bottomRight = (int(bottomRight[0]), int(bottomRight[1]))
@@ -153,14 +373,48 @@ def detect_landmarks(image: np.ndarray, camera_matrix: np.ndarray, distortion_co
             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0),
             2)
 
-    return (image, list(zip([id[0] for id in ids], [np.array([distance, angle, orientation]) for angle, distance, orientation in zip(angles, distances, orientations)])))
+    # One (N, 3) block, each landmark gets a row of it
+    measurements = np.column_stack([distances, angles, orientations])
+    return (image, [(int(id[0]), measurement) for id, measurement in zip(ids, measurements)])
+
+
+@njit(cache=True, fastmath=True)
+def yaw_from_quaternion(x: np.ndarray, y: np.ndarray, z: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """Yaw (rotation around z in radians, counterclockwise) of an array of quaternions."""
+    t3 = 2.0 * (w * z + x * y)
+    t4 = 1.0 - 2.0 * (y * y + z * z)
+    return np.arctan2(t3, t4)
+
+
+def decode_image(data: np.ndarray) -> np.ndarray:
+    """Decode a compressed (jpeg) camera frame into a BGR image."""
+    if _TURBOJPEG is not None:
+        try:
+            return _TURBOJPEG.decode(data.tobytes())
+        except OSError:
+            pass  # Not a jpeg, let OpenCV figure it out
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def process_frame(msg_data: np.ndarray, timestamp: int, camera_matrix: np.ndarray, distortion_coefficients: np.ndarray,
+                  save_imgs: bool = False) -> tuple[int, list, np.ndarray]:
+    """Decode a compressed camera frame and detect the landmarks in it.
+
+    Returns:
+        (timestamp, landmarks, annotated image re-encoded as jpeg or None if
+        save_imgs is False)
+    """
+    img = decode_image(msg_data)
+    annotated_img, landmarks = detect_landmarks(img, camera_matrix, distortion_coefficients)
+    Compressed_Annotated = None
+    if save_imgs:
+        Compressed_Annotated = cv2.imencode('.jpeg', annotated_img)[1]
+    return (timestamp, landmarks, Compressed_Annotated)
 
 
 def rosbag_to_data(rosbag_path: os.PathLike, save_imgs=False) -> SensorData:
     laser_ros = []
     odom_ros = []
-    cam_ros_sim = []
-    cam_ros_real = []
     camera_matrix = np.empty((3,3))
     distortion_coefficients = np.empty((5,))
     with rosbags.rosbag1.Reader(rosbag_path) as reader:
@@ -180,59 +434,65 @@ def rosbag_to_data(rosbag_path: os.PathLike, save_imgs=False) -> SensorData:
                 connections_cam.append(x)
             elif x.topic == '/raspicam_node/camera_info':
                 connections_cam_info.append(x)
-        if len(connections_laser) != 0:
-            for connection, timestamp, rawdata in reader.messages(connections=connections_laser):
-                msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
-                laser_ros.append((timestamp, msg.ranges))
-        if len(connections_odom) != 0:
-            for connection, timestamp, rawdata in reader.messages(connections=connections_odom):
-                msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
-                def euler_from_quaternion(x, y, z, w):
-                    import math
-                    """
-                    Convert a quaternion into euler angles (roll, pitch, yaw)
-                    roll is rotation around x in radians (counterclockwise)
-                    pitch is rotation around y in radians (counterclockwise)
-                    yaw is rotation around z in radians (counterclockwise)
-                    """
-                    t0 = +2.0 * (w * x + y * z)
-                    t1 = +1.0 - 2.0 * (x * x + y * y)
-                    roll_x = math.atan2(t0, t1)
-                
-                    t2 = +2.0 * (w * y - z * x)
-                    t2 = +1.0 if t2 > +1.0 else t2
-                    t2 = -1.0 if t2 < -1.0 else t2
-                    pitch_y = math.asin(t2)
-                
-                    t3 = +2.0 * (w * z + x * y)
-                    t4 = +1.0 - 2.0 * (y * y + z * z)
-                    yaw_z = math.atan2(t3, t4)
-                
-                    return roll_x, pitch_y, yaw_z # in radians
-                theta, x, y = euler_from_quaternion(msg.pose.pose.orientation.x, msg.pose.pose.orientation.y,
-                              msg.pose.pose.orientation.z, msg.pose.pose.orientation.w)[2], \
-                              msg.pose.pose.position.x, msg.pose.pose.position.y
-                odom_ros.append((timestamp, np.array([theta, x, y])))
         if len(connections_cam_sim) != 0:
             raise NotImplementedError('Camera on simulation not implemented')
-            for connection, timestamp, rawdata in reader.messages(connections=connections_cam_sim):
-                msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
-                cam_ros_sim.append((detect_landmarks(msg), timestamp))
+        # Frames can only be processed once the camera parameters are known, so read
+        # the (tiny) camera info topic first and everything else in a single pass
         if len(connections_cam_info) != 0:
             for connection, timestamp, rawdata in reader.messages(connections=connections_cam_info):
                 msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
                 camera_matrix = msg.k.reshape((3,3))
                 distortion_coefficients = msg.d
-        if len(connections_cam) != 0:
-            for connection, timestamp, rawdata in reader.messages(connections=connections_cam):
-                msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
-                img = cv2.imdecode(msg.data, cv2.IMREAD_COLOR)
-                annotated_img, landmarks = detect_landmarks(img, camera_matrix, distortion_coefficients)
-                Compressed_Annotated = None
-                if save_imgs:
-                    Compressed_Annotated = cv2.imencode('.jpeg', annotated_img)[1]
-                cam_ros_real.append((timestamp, landmarks, Compressed_Annotated))
 
+        # Message counts come from the bag index, so the streams are filled in place
+        n_laser = sum(connection.msgcount for connection in connections_laser)
+        laser_ts = np.empty((n_laser,), dtype=np.int64)
+        laser_ranges = None
+        n_odom = sum(connection.msgcount for connection in connections_odom)
+        odom_ts = np.empty((n_odom,), dtype=np.int64)
+        quaternions = np.empty((n_odom, 4))     # x, y, z, w
+        odom_vals = np.empty((n_odom, 3))       # theta, x, y
+        laser_idx, odom_idx = 0, 0
+        # Frames are independent and OpenCV releases the GIL while decoding and
+        # detecting, so they are spread over a thread pool as they are read. Only a
+        # few are in flight at once, so the frames of a long bag are not all held in
+        # memory; results are collected in reading order
+        cam_ros_real = []
+        pending_frames = collections.deque()
+        max_workers = os.cpu_count() or 1
+        connections = connections_laser + connections_odom + connections_cam
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # An empty connection list would make the reader yield every topic
+            for connection, timestamp, rawdata in (reader.messages(connections=connections) if connections else ()):
+                msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
+                if connection.topic == '/scan':
+                    if laser_ranges is None:
+                        laser_ranges = np.empty((n_laser, len(msg.ranges)), dtype=msg.ranges.dtype)
+                    laser_ts[laser_idx] = timestamp
+                    laser_ranges[laser_idx] = msg.ranges
+                    laser_idx += 1
+                elif connection.topic == '/odom':
+                    orientation, position = msg.pose.pose.orientation, msg.pose.pose.position
+                    odom_ts[odom_idx] = timestamp
+                    quaternions[odom_idx, 0] = orientation.x
+                    quaternions[odom_idx, 1] = orientation.y
+                    quaternions[odom_idx, 2] = orientation.z
+                    quaternions[odom_idx, 3] = orientation.w
+                    odom_vals[odom_idx, 1] = position.x
+                    odom_vals[odom_idx, 2] = position.y
+                    odom_idx += 1
+                else:
+                    pending_frames.append(executor.submit(process_frame, msg.data, timestamp, camera_matrix,
+                                                          distortion_coefficients, save_imgs))
+                    if len(pending_frames) > 2*max_workers:
+                        cam_ros_real.append(pending_frames.popleft().result())
+            cam_ros_real.extend(frame.result() for frame in pending_frames)
+
+        if n_laser != 0:
+            laser_ros = SensorStream(laser_ts, laser_ranges)
+        if n_odom != 0:
+            odom_vals[:, 0] = yaw_from_quaternion(*quaternions.T)
+            odom_ros = SensorStream(odom_ts, odom_vals)
 
     return SensorData(odometry=odom_ros, lidar=laser_ros, camera=cam_ros_real, comment='From rosbag', from_rosbag=True)
 
@@ -245,7 +505,7 @@ def rosbag_to_imgs(rosbag_path: os.PathLike) -> list[np.ndarray]:
         imgs = []
         for connection, timestamp, rawdata in reader.messages(connections=connections_cam):
             msg = rosbags.serde.deserialize_cdr(rosbags.serde.ros1_to_cdr(rawdata, connection.msgtype), connection.msgtype)
-            img = cv2.imdecode(msg.data, cv2.IMREAD_COLOR)
+            img = decode_image(msg.data)
             imgs.append(img)
     return imgs
 
@@ -264,27 +524,32 @@ def rosbag_camera_info(rosbag_path: os.PathLike) -> list[np.ndarray]:
     return (camera_matrix, distortion_coefficients)
 
 def list_to_data(sensor_data_lst: list[tuple[np.ndarray, list[tuple[int, float]], np.ndarray]], ts: float, comment: str = '') -> SensorData:
-    odom: np.ndarray = np.array([sensor_data_lst_elem[0] for sensor_data_lst_elem in sensor_data_lst])
-    lidar: np.ndarray = np.array([sensor_data_lst_elem[2] for sensor_data_lst_elem in sensor_data_lst])
-    landmarks: list = [sensor_data_lst_elem[1] for sensor_data_lst_elem in sensor_data_lst]
+    """Build sensor data from a list of (odometry, landmarks, lidar) samples, as
+    returned by usim.sensor.Sensor.sample_sensors, taken every ts seconds."""
+    timestamps = np.round(np.arange(len(sensor_data_lst)) * ts * 1e9).astype(np.int64)
+    if sensor_data_lst:
+        odom = SensorStream(timestamps, np.stack([sensor_data_lst_elem[0] for sensor_data_lst_elem in sensor_data_lst]))
+        lidar = SensorStream(timestamps, np.stack([sensor_data_lst_elem[2] for sensor_data_lst_elem in sensor_data_lst]))
+    else:
+        odom, lidar = [], []
+    landmarks: list = [(int(t), sensor_data_lst_elem[1], None) for t, sensor_data_lst_elem in zip(timestamps, sensor_data_lst)]
     if not comment:
         comment = 'From list'
     else:
         comment += '\nFrom list'
-    return SensorData(ts=ts, odometry=odom, lidar=lidar, camera=landmarks, comment=comment, from_rosbag=False)
+    return SensorData(odometry=odom, lidar=lidar, camera=landmarks, comment=comment, from_rosbag=False)
 
 
-def add_comment(comment: str, filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR) -> None:
-    with lzma.open(os.path.join(dir, filename), 'rb') as f:
-        data_dict = pickle.load(f)
+def add_comment(comment: str, filename: str, dir: os.PathLike=DEFAULT_SENSOR_DATA_DIR,
+                compression: str = None) -> None:
+    sensor_data = load_sensor_data(filename, dir)
 
-    if data_dict['comment'] != '':
-        data_dict['comment'] += '\n'
+    if sensor_data.comment != '':
+        sensor_data.comment += '\n' + comment
     else:
-        data_dict['comment'] = comment
+        sensor_data.comment = comment
 
-    with lzma.open(os.path.join(dir, filename), 'wb') as f:
-        pickle.dump(data_dict, f)
+    save_sensor_data(sensor_data, filename, dir, compression)
 
 
 if __name__ == '__main__':
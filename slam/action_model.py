@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import math
 
 import numpy as np
 
@@ -37,28 +38,25 @@ def action_model(state: np.ndarray, odometry: np.ndarray,
     x, y, theta = state
     odom_forward, odom_left, odom_theta = odometry  # state change in robot frame
 
+    # The displacement is kept as two floats, (dx, dy), in the world frame
     if settings.action_type == ActionType.TANGENT:
         delta_theta = odom_theta
-        distance_moved = np.linalg.norm(odometry[0:2])
-        delta_pos = distance_moved * np.array([np.cos(theta), np.sin(theta)]) * np.sign(odom_forward)
+        distance_moved = math.hypot(odom_forward, odom_left) * np.sign(odom_forward)
+        dx, dy = distance_moved * math.cos(theta), distance_moved * math.sin(theta)
     elif settings.action_type == ActionType.TANGENT_CORR:
         delta_theta = odom_theta
-        distance_moved = np.linalg.norm(odometry[0:2])
-        delta_pos = distance_moved * np.array([np.cos(theta + delta_theta/2),
-                                              np.sin(theta + delta_theta/2)]) * np.sign(odom_forward)
+        distance_moved = math.hypot(odom_forward, odom_left) * np.sign(odom_forward)
+        dx, dy = distance_moved * math.cos(theta + delta_theta/2), distance_moved * math.sin(theta + delta_theta/2)
     elif settings.action_type == ActionType.FREE:
-        delta_pos_robot_frame = odometry[0:2]
         # Rotate to frame of world
-        R = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-        delta_pos = R @ delta_pos_robot_frame
+        c, s = math.cos(theta), math.sin(theta)
+        dx, dy = c*odom_forward - s*odom_left, s*odom_forward + c*odom_left
         delta_theta = odom_theta
     else:
         raise ValueError('Action model ActionType definition is invalid - is this code reachable?')
 
     if settings.uncertainty_type == UncertaintyType.POSE_ADD:
-        new_state = np.array([x + delta_pos[0],
-                              y + delta_pos[1],
-                              theta + delta_theta])
+        new_state = np.array([x + dx, y + dy, theta + delta_theta])
         new_state += np.random.multivariate_normal(settings.POSE_ADD_MU,
                                                    settings.POSE_ADD_COV)
 
@@ -67,22 +65,77 @@ def action_model(state: np.ndarray, odometry: np.ndarray,
             settings.ODOM_ADD_MU,
             settings.ODOM_ADD_COV
         )
-        delta_pos *= (1 + r_noise/np.linalg.norm(delta_pos))
+        scale = 1 + r_noise/math.hypot(dx, dy)
+        dx, dy = dx*scale, dy*scale
         delta_theta += delta_theta_noise
-        new_state = np.array([x + delta_pos[0],
-                              y + delta_pos[1],
-                              theta + delta_theta])
+        new_state = np.array([x + dx, y + dy, theta + delta_theta])
     elif settings.uncertainty_type == UncertaintyType.ODOM_MULT:
         r_factor, delta_theta_factor = np.random.multivariate_normal(
             settings.ODOM_MULT_MU,
             settings.ODOM_MULT_COV
         )
-        delta_pos *= r_factor
+        dx, dy = dx*r_factor, dy*r_factor
         delta_theta *= delta_theta_factor
-        new_state = np.array([x + delta_pos[0],
-                              y + delta_pos[1],
-                              theta + delta_theta])
+        new_state = np.array([x + dx, y + dy, theta + delta_theta])
     else:
         raise ValueError('Action model UncertaintyType definition is invalid - is this code reachable?')
 
     return new_state
+
+
+def action_model_batch(states: np.ndarray, odometry: np.ndarray,
+                       settings: ActionModelSettings = ActionModelSettings()) -> np.ndarray:
+    """action_model applied to each row of an (N, 3) array of states at once.
+
+    Noise is drawn for all states in a single call, consuming the random stream in the same
+    order as N calls of action_model would.
+    """
+    states = np.asarray(states, dtype=float)
+    x, y, theta = states[:, 0], states[:, 1], states[:, 2]
+    odom_forward, odom_left, odom_theta = odometry  # state change in robot frame
+    N = states.shape[0]
+
+    # The displacement is kept as two (N,) arrays, (dx, dy), in the world frame
+    if settings.action_type == ActionType.TANGENT:
+        delta_theta = np.full(N, float(odom_theta))
+        distance_moved = math.hypot(odom_forward, odom_left) * np.sign(odom_forward)
+        dx, dy = distance_moved * np.cos(theta), distance_moved * np.sin(theta)
+    elif settings.action_type == ActionType.TANGENT_CORR:
+        delta_theta = np.full(N, float(odom_theta))
+        distance_moved = math.hypot(odom_forward, odom_left) * np.sign(odom_forward)
+        dx, dy = distance_moved * np.cos(theta + delta_theta/2), distance_moved * np.sin(theta + delta_theta/2)
+    elif settings.action_type == ActionType.FREE:
+        # Rotate to frame of world
+        c, s = np.cos(theta), np.sin(theta)
+        dx, dy = c*odom_forward - s*odom_left, s*odom_forward + c*odom_left
+        delta_theta = np.full(N, float(odom_theta))
+    else:
+        raise ValueError('Action model ActionType definition is invalid - is this code reachable?')
+
+    if settings.uncertainty_type == UncertaintyType.POSE_ADD:
+        new_states = np.column_stack([x + dx, y + dy, theta + delta_theta])
+        new_states += np.random.multivariate_normal(settings.POSE_ADD_MU,
+                                                    settings.POSE_ADD_COV, size=N)
+    elif settings.uncertainty_type == UncertaintyType.ODOM_ADD:
+        r_noise, delta_theta_noise = np.random.multivariate_normal(
+            settings.ODOM_ADD_MU,
+            settings.ODOM_ADD_COV,
+            size=N
+        ).T
+        scale = 1 + r_noise/np.hypot(dx, dy)
+        dx, dy = dx*scale, dy*scale
+        delta_theta += delta_theta_noise
+        new_states = np.column_stack([x + dx, y + dy, theta + delta_theta])
+    elif settings.uncertainty_type == UncertaintyType.ODOM_MULT:
+        r_factor, delta_theta_factor = np.random.multivariate_normal(
+            settings.ODOM_MULT_MU,
+            settings.ODOM_MULT_COV,
+            size=N
+        ).T
+        dx, dy = dx*r_factor, dy*r_factor
+        delta_theta *= delta_theta_factor
+        new_states = np.column_stack([x + dx, y + dy, theta + delta_theta])
+    else:
+        raise ValueError('Action model UncertaintyType definition is invalid - is this code reachable?')
+
+    return new_states
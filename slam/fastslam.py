@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import inspect
+import math
 import struct
 import hashlib
 from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.collections import PathCollection
+
+if TYPE_CHECKING:
+    # matplotlib is imported by the visualizer methods (settings.visualize), as it is slow to import
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PathCollection
 
 from slam.map import OrientedLandmarkSettings, Map, Observation
-from slam.action_model import ActionModelSettings, action_model
+from slam.action_model import ActionModelSettings, action_model, action_model_batch
 from slam.resampling import ResampleType
-from slam.particle import Particle
+from slam.particle import Particle, draw_particles, make_oriented_observation_batch
+
+_PACK_F = struct.Struct("f").pack
 
 @dataclass
 class FastSLAMSettings:
@@ -43,7 +50,7 @@ class FastSLAMSettings:
         self.landmark_settings.min_cov.flags.writeable = False
         # ast.parse(inspect.getsource(self.resampling_type)).body[0].value.string
         vars_to_hash =[
-            bytearray(struct.pack("f", self.num_particles)),
+            _PACK_F(self.num_particles),
             self.action_model_settings.action_type.name.encode(),
             self.action_model_settings.uncertainty_type.name.encode(),
             self.action_model_settings.ODOM_ADD_MU.data,
@@ -56,12 +63,12 @@ class FastSLAMSettings:
             self.resampling_type.__name__.encode(),
             # bytearray(struct.pack("f", self.t0)),
             # bytearray(struct.pack("f", self.tf)),
-            bytearray(struct.pack("f", self.r_std)),
-            bytearray(struct.pack("f", self.phi_std)),
-            bytearray(struct.pack("f", self.psi_std)),
-            bytearray(struct.pack("f", self.r_std_line)),
-            bytearray(struct.pack("f", self.phi_std_line)),
-            bytearray(struct.pack("f", self.rng_seed if self.rng_seed is not None else -1))
+            _PACK_F(self.r_std),
+            _PACK_F(self.phi_std),
+            _PACK_F(self.psi_std),
+            _PACK_F(self.r_std_line),
+            _PACK_F(self.phi_std_line),
+            _PACK_F(self.rng_seed if self.rng_seed is not None else -1)
         ]
         all_bytes_joined = b''.join(vars_to_hash)
         return hashlib.sha1(all_bytes_joined).hexdigest()
@@ -77,11 +84,14 @@ class SLAMResult:
 class FastSLAM:
     def __init__(self, settings: FastSLAMSettings = FastSLAMSettings(), ax: plt.Axes = None) -> None:
         self.settings: FastSLAMSettings = settings
-        self.action_model = lambda pose, odometry: action_model(pose, odometry, self.settings.action_model_settings)
+        # May be replaced by another motion model; the default one moves all particles at once
+        self.action_model = self._default_action_model
         self.particles: list[Particle] = [Particle(default_landmark_settings=settings.landmark_settings) for _ in range(settings.num_particles)]
         self.particle_markers = [None]*settings.num_particles
         self.n_gain = np.diag([settings.r_std, settings.phi_std, settings.psi_std])
         self.n_gain_line = np.diag([settings.r_std_line, settings.phi_std_line])
+        # Shared by the data association of every particle
+        self.n_cov_line = self.n_gain_line @ self.n_gain_line.T
 
         # Contains the estimated location of the robot as a list of (time, [x, y, theta])
         self.trajectory_estimate: list[tuple[int, np.ndarray]] = []
@@ -89,6 +99,7 @@ class FastSLAM:
 
         if settings.visualize:
             if ax is None:
+                import matplotlib.pyplot as plt
                 _, ax = plt.subplots()
                 self.ax = ax
             else:
@@ -112,15 +123,24 @@ class FastSLAM:
         if actual_location is not None:
             self.actual_trajectory += [(self.cur_time, actual_location)]
 
-        def action(pose): return self.action_model(pose, odometry)
-
-        for i in range(len(self.particles)):
-            self.particles[i].apply_action(action)        
+        if self.action_model == self._default_action_model:
+            # All poses are moved at once; each particle's pose becomes a row of the new array
+            poses = action_model_batch(self._poses(), odometry, self.settings.action_model_settings)
+            for particle, pose in zip(self.particles, poses):
+                particle.pose = pose
+        else:
+            def action(pose): return self.action_model(pose, odometry)
+            for particle in self.particles:
+                particle.apply_action(action)
 
         if t < self.cur_time:
             print(
                 f'[WARNING] ({inspect.currentframe().f_code.co_name}) Time is going backwards!\n\tLatest sample time: {self.cur_time}\n\tNew sample time: {t}')
         self.cur_time = t
+
+    def _default_action_model(self, pose: np.ndarray, odometry: np.ndarray) -> np.ndarray:
+        return action_model(pose, odometry, self.settings.action_model_settings)
+
     def make_unoriented_observation(self, t: float, obs_data: tuple[int, tuple[float, float]]) -> None:
         """Updates all particles' maps using the observation data, and 
         reweighs the particles based on the likelihood of the observation.
@@ -145,9 +165,7 @@ class FastSLAM:
         Args:
             observation: The observation data as a tuple of (id, [r (m), phi (rad), psi(rad)])
         """
-        changed_mask = np.empty((len(self.particles),), dtype=bool)
-        for i, particle in enumerate(self.particles):
-            changed_mask[i] = particle.make_oriented_observation(obs_data, self.n_gain)
+        changed_mask = make_oriented_observation_batch(self.particles, obs_data, self.n_gain)
 
         self._normalize_some_particle_weights(changed_mask)
 
@@ -165,7 +183,7 @@ class FastSLAM:
         """
         changed_mask = np.empty((len(self.particles),), dtype=bool)
         for i, particle in enumerate(self.particles):
-            changed_mask[i] = particle.make_line_observation(obs_data, self.n_gain_line)
+            changed_mask[i] = particle.make_line_observation(obs_data, self.n_gain_line, self.n_cov_line)
 
         self._normalize_some_particle_weights(changed_mask)
 
@@ -176,7 +194,7 @@ class FastSLAM:
     def resample(self) -> None:
         """Resamples the particles based on their weights.
         """
-        weights = np.array([particle.weight for particle in self.particles])
+        weights = self._weights()
         if any(weights - weights[0] != 0):
             self.particles = self.settings.resampling_type(self.particles, weights, self.settings.num_particles)
 
@@ -186,8 +204,8 @@ class FastSLAM:
         Returns:
             The estimated location of the robot as a numpy array of [x, y, theta]
         """
-        return np.sum([particle.pose * particle.weight for particle in self.particles],
-                      axis=0) / np.sum([particle.weight for particle in self.particles])
+        weights = self._weights()
+        return np.sum(self._poses() * weights[:, None], axis=0) / np.sum(weights)
 
     def map_estimate(self) -> Map:
         """Returns the map of the robot.
@@ -195,7 +213,7 @@ class FastSLAM:
         Returns:
             The map of the robot.
         """
-        particle_idx_for_map = np.argmax(np.array([particle.weight for particle in self.particles]), axis=0)
+        particle_idx_for_map = np.argmax(self._weights())
         map_estimate: Map = self.particles[particle_idx_for_map].map
         return map_estimate
 
@@ -210,20 +228,51 @@ class FastSLAM:
         actual_trajectory = self.actual_trajectory if self.actual_trajectory else None
         return SLAMResult(map=map, trajectory=trajectory_estimate, actual_trajectory=actual_trajectory)
 
+    def _poses(self) -> np.ndarray:
+        """(N, 3) array with the pose of each particle."""
+        return np.array([particle.pose for particle in self.particles], dtype=float)
+
+    def _weights(self) -> np.ndarray:
+        """(N,) array with the weight of each particle relative to the largest one, which is 1."""
+        log_weights = self._log_weights()
+        return np.exp(log_weights - log_weights.max())
+
+    def _log_weights(self) -> np.ndarray:
+        """(N,) array with the log weight of each particle."""
+        return np.fromiter((particle.log_weight for particle in self.particles), dtype=float, count=len(self.particles))
+
+    def _set_log_weights(self, log_weights: np.ndarray) -> None:
+        for particle, log_weight in zip(self.particles, log_weights.tolist()):
+            particle.log_weight = log_weight
+
     def _normalize_particle_weights(self) -> None:
-        weights = np.array([particle.weight for particle in self.particles])
-        weights = weights / weights.sum()
-        for i, particle in enumerate(self.particles):
-            particle.weight = weights[i]
+        log_weights = self._log_weights()
+        log_weights -= log_weights.max()
+        log_weights -= math.log(np.exp(log_weights).sum())
+        self._set_log_weights(log_weights)
 
     def _normalize_some_particle_weights(self, changed_mask : np.ndarray(dtype=bool)) -> None:  
         """ Keeps not changed_mask particles with same probability, normalizes the rest.
             Assumes that the weights summed to 1 before being changed
         """      
-        weights = np.array([particle.weight for particle in self.particles])
-        weights[changed_mask] = (1 - weights[~changed_mask].sum()) * weights[changed_mask] / weights[changed_mask].sum()
-        for i, particle in enumerate(self.particles):
-            particle.weight = weights[i]
+        if not changed_mask.any():
+            return
+        log_weights = self._log_weights()
+        unchanged = log_weights[~changed_mask]
+        unchanged_mass = 0.
+        unchanged_max = unchanged.max() if unchanged.size else -math.inf
+        if unchanged_max > -math.inf:
+            unchanged_mass = math.exp(unchanged_max) * np.exp(unchanged - unchanged_max).sum()
+        if not unchanged_mass < 1:
+            # Nothing left for the changed particles (the weights did not sum to 1): normalize all of them
+            self._normalize_particle_weights()
+            return
+        # Normalized in log space, relative to the largest changed weight, so none of them underflows
+        changed = log_weights[changed_mask]
+        changed -= changed.max()
+        changed -= math.log(np.exp(changed).sum())
+        log_weights[changed_mask] = changed + math.log1p(-unchanged_mass)
+        self._set_log_weights(log_weights)
 
     # Visualization methods (if settings.visualize is True)
     def _init_visualizer(self, ylim: tuple = (-3, 3), xlim: tuple = (-3, 3)) -> None:
@@ -247,8 +296,7 @@ class FastSLAM:
                 [], [], c='C04', linewidth=0.5, label='Estimated trajectory')
 
     def _draw_location(self) -> None:
-        for idx, particle in enumerate(self.particles):
-            particle._draw(self.particle_markers[idx])
+        draw_particles(self.particles, self.particle_markers)
         if self.actual_trajectory:
             self.actual_location_dot.set(offsets = [self.actual_trajectory[-1][1][:2]])
 
@@ -264,7 +312,7 @@ class FastSLAM:
                 list(prev_traj_est[1]) + [pose_estimate[1]])
 
     def _draw_map(self) -> None:
-        particle_idx_for_map = np.argmax(np.array([particle.weight for particle in self.particles]), axis=0)
+        particle_idx_for_map = np.argmax(self._weights())
         new = self.particles[particle_idx_for_map].map
         if self.drawn_map_estimate is not new:
             self.drawn_map_estimate._undraw()
@@ -273,6 +321,7 @@ class FastSLAM:
         self.drawn_map_estimate._draw(self.ax, color_ellipse='C01', color_p='C01', color_z='C01')
 
     def _draw(self) -> None:
+        import matplotlib.pyplot as plt
         # self.ax.relim()
         self._draw_location()
         self._draw_map()
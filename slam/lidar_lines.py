@@ -1,5 +1,6 @@
 import os
 import copy
+import math
 import shutil
 
 import numpy as np
@@ -77,8 +78,11 @@ def identify_lines(scan: np.ndarray, plot_ax: plt.Axes = None, demo: bool = Fals
     good = np.where(scan > 0.01)[0] 
     angles = good.astype(float)*np.pi/180
     cleaned_scan = scan[good]
-    xypoints = (np.array([np.cos(angles), np.sin(angles)]) * cleaned_scan).T
-    xypoints = np.block([xypoints, np.ones_like([xypoints[:, 0]]).T])
+    # Homogeneous coordinates (x, y, 1) of each point
+    xypoints = np.empty((cleaned_scan.shape[0], 3))
+    xypoints[:, 0] = np.cos(angles) * cleaned_scan
+    xypoints[:, 1] = np.sin(angles) * cleaned_scan
+    xypoints[:, 2] = 1
     model = StraightLineModel()
 
     minp = 15
@@ -117,7 +121,7 @@ def identify_lines(scan: np.ndarray, plot_ax: plt.Axes = None, demo: bool = Fals
         rh = -c/np.sqrt(a**2 + b**2)
         if rh < 0:
             rh, th = -rh, th + np.pi
-        th = np.mod(th + np.pi, 2*np.pi) - np.pi
+        th = math.remainder(th, 2*math.pi)
         return (rh, th), best_inliers, best_model
 
     if demo:
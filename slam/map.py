@@ -1,62 +1,277 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from enum import Enum
 import math
 import copy
+import functools
 import os
-from matplotlib.lines import Line2D
 
-import scipy.stats
 import numpy as np
-from matplotlib.collections import PathCollection
-from matplotlib.patches import Ellipse
 
 from ekf.ekf import EKF, EKFSettings
-from visualization_utils.mpl_video import to_video
+from math_extra import njit, wrap_angle
+
+# matplotlib and scipy.stats are imported where they are first needed, so that
+# headless runs do not pay for them when importing the map
+
+# Landmarks are static, so the default motion model Jacobians are constant. They are shared
+# between all landmarks and read-only: copy before modifying
+_I2 = np.eye(2)
+_I2.setflags(write=False)
+_Z2 = np.zeros((2, 2))
+_Z2.setflags(write=False)
 
 def default_g(x, u):
     return x
 
 def default_gDgx(x, u):
-    return np.eye(2)
+    return _I2
 
 def default_gDgm(x, u):
-    return np.zeros((2, 2))
+    return _Z2
 
-def h_inv_line(z, parameters):
-    p, theta, R, lidar_vector, n_gain = parameters
-    rh_robot, th_robot = z
+# The line sensor model is evaluated for every line, landmark and particle, so its
+# math lives in numba kernels on plain floats. The wrappers below unpack `parameters`
+# (p, theta, R, lidar_vector, n_gain) into scalars, once per call for plain tuples and
+# once per observation for LineParameters. The Jacobian also needs p in polar form
+# (rho, alpha), which only depends on the pose and so is computed alongside
+
+def _unpack_line_parameters(p, theta, R, lidar_vector, n_gain):
+    return (float(p[0]), float(p[1]), float(theta), float(R[0, 0]), float(R[0, 1]), float(R[1, 0]), float(R[1, 1]),
+            float(lidar_vector[0]), float(lidar_vector[1]))
+
+def _polar(px, py):
+    return math.sqrt(px*px + py*py), math.atan2(py, px)
+
+class LineParameters(tuple):
+    """Parameters (p, theta, R, lidar_vector, n_gain) of the line sensor model.
+
+    Behaves as the plain tuple, but the scalars the line kernels take are unpacked when it is
+    built rather than by every h/h_inv/Dhx evaluation made with it. The arrays must not be
+    modified afterwards.
+    """
+    def __new__(cls, p, theta, R, lidar_vector, n_gain):
+        self = super().__new__(cls, (p, theta, R, lidar_vector, n_gain))
+        self.scalars = _unpack_line_parameters(p, theta, R, lidar_vector, n_gain)
+        self.polar = _polar(*self.scalars[0:2])
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+def _line_parameters(parameters):
+    if type(parameters) is LineParameters:
+        return parameters.scalars
+    return _unpack_line_parameters(*parameters)
+
+def _line_polar(parameters):
+    if type(parameters) is LineParameters:
+        return parameters.polar
+    return _polar(*_line_parameters(parameters)[0:2])
+
+@njit(cache=True, fastmath=True)
+def _h_inv_line_core(rh_robot, th_robot, px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy):
     th_world = np.mod(th_robot + theta + np.pi, 2*np.pi) - np.pi
-    point_on_line_world = R @ (np.array([rh_robot * np.cos(th_robot), rh_robot * np.sin(th_robot)]) + lidar_vector) + p
-    rh_world = point_on_line_world.dot(np.array([np.cos(th_world), np.sin(th_world)]))
-    x = rh_world, th_world
+    # R @ (point on line in the robot's frame + lidar_vector) + p
+    vx, vy = rh_robot * np.cos(th_robot) + lvx, rh_robot * np.sin(th_robot) + lvy
+    wx, wy = Rxx*vx + Rxy*vy + px, Ryx*vx + Ryy*vy + py
+    rh_world = wx*np.cos(th_world) + wy*np.sin(th_world)
     if rh_world < 0:
-        x = -rh_world, np.mod(th_world + 2*np.pi, 2*np.pi) - np.pi
-    return np.array(x)
-    
-def h_line(x, parameters):
-    p, theta, R, lidar_vector, n_gain = parameters
-    rh_world, th_world = x
+        return -rh_world, np.mod(th_world + 2*np.pi, 2*np.pi) - np.pi
+    return rh_world, th_world
+
+@njit(cache=True, fastmath=True)
+def _h_line_core(rh_world, th_world, px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy):
     th_robot = np.mod(th_world - theta + np.pi, 2*np.pi) - np.pi
-    point_on_line_robot = R.T @ (np.array([rh_world * np.cos(th_world), rh_world * np.sin(th_world)]) - p) - lidar_vector
-    rh_robot = point_on_line_robot.dot(np.array([np.cos(th_robot), np.sin(th_robot)]))
-    z = [rh_robot, th_robot]
+    # R.T @ (point on line in the world frame - p) - lidar_vector
+    vx, vy = rh_world * np.cos(th_world) - px, rh_world * np.sin(th_world) - py
+    wx, wy = Rxx*vx + Ryx*vy - lvx, Rxy*vx + Ryy*vy - lvy
+    rh_robot = wx*np.cos(th_robot) + wy*np.sin(th_robot)
     if rh_robot < 0:
-        z = [-rh_robot, np.mod(th_robot + 2*np.pi, 2*np.pi) - np.pi]
-    return np.array(z)
+        return -rh_robot, np.mod(th_robot + 2*np.pi, 2*np.pi) - np.pi
+    return rh_robot, th_robot
+
+@njit(cache=True, fastmath=True)
+def _Dhx_line_core(rh_world, th_world, px, py, rho, alpha):
+    """First row of get_Dhx_line (the second one is always [0, 1]); (rho, alpha) is p in polar form."""
+    direction = - np.sign(px*np.cos(th_world) + py*np.sin(th_world) - rh_world)
+    return direction, rho * np.sin(th_world - alpha + (- direction + 1) / 2 * np.pi)
+
+@njit(cache=True, fastmath=True)
+def _h_inv_line_batch_core(zs, px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy):
+    xs = np.empty((zs.shape[0], 2))
+    for i in range(zs.shape[0]):
+        xs[i, 0], xs[i, 1] = _h_inv_line_core(zs[i, 0], zs[i, 1], px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy)
+    return xs
+
+@njit(cache=True, fastmath=True)
+def _h_line_batch_core(xs, px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy):
+    zs = np.empty((xs.shape[0], 2))
+    for i in range(xs.shape[0]):
+        zs[i, 0], zs[i, 1] = _h_line_core(xs[i, 0], xs[i, 1], px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy)
+    return zs
+
+@njit(cache=True, fastmath=True)
+def _Dhx_line_batch_core(xs, px, py, rho, alpha):
+    dhx = np.zeros((xs.shape[0], 2, 2))
+    for i in range(xs.shape[0]):
+        dhx[i, 0, 0], dhx[i, 0, 1] = _Dhx_line_core(xs[i, 0], xs[i, 1], px, py, rho, alpha)
+        dhx[i, 1, 1] = 1
+    return dhx
+
+@njit(cache=True, fastmath=True)
+def _line_mahalanobis_sqr_batch_core(rh, th, xs, covs, px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy, rho, alpha, N00, N01, N11):
+    d2 = np.empty(xs.shape[0])
+    for i in range(xs.shape[0]):
+        rh_hat, th_hat = _h_line_core(xs[i, 0], xs[i, 1], px, py, theta, Rxx, Rxy, Ryx, Ryy, lvx, lvy)
+        a, b = _Dhx_line_core(xs[i, 0], xs[i, 1], px, py, rho, alpha)
+        # S = Dhx @ cov @ Dhx.T + N, with Dhx = [[a, b], [0, 1]]
+        c00, c01, c10, c11 = covs[i, 0, 0], covs[i, 0, 1], covs[i, 1, 0], covs[i, 1, 1]
+        S00 = a*a*c00 + a*b*(c01 + c10) + b*b*c11 + N00
+        S01 = a*c01 + b*c11 + N01
+        S10 = a*c10 + b*c11 + N01
+        S11 = c11 + N11
+        e0 = rh - rh_hat
+        e1 = wrap_angle(th - th_hat)
+        # e.T @ inv(S) @ e, with the 2x2 inverse written out
+        d2[i] = (S11*e0*e0 - (S01 + S10)*e0*e1 + S00*e1*e1) / (S00*S11 - S01*S10)
+    return d2
+
+def h_inv_line(z, parameters):
+    return np.array(_h_inv_line_core(float(z[0]), float(z[1]), *_line_parameters(parameters)))
+    
+def h_line(x, parameters):
+    return np.array(_h_line_core(float(x[0]), float(x[1]), *_line_parameters(parameters)))
 
 def get_Dhx_line(x, parameters):
-    p, theta, R, lidar_vector, n_gain = parameters
-    dhx = np.eye(2)
-    direction = - np.sign(p.dot(np.array([np.cos(x[1]), np.sin(x[1])])) - x[0])
-    rho, alpha = np.linalg.norm(p), np.arctan2(p[1], p[0])
-    dhx[0, 0] = direction
-    dhx[0, 1] = rho * np.sin(x[1] - alpha + (- direction + 1) / 2 * np.pi)
-    return dhx
+    px, py = _line_parameters(parameters)[0:2]
+    direction, dhx_01 = _Dhx_line_core(float(x[0]), float(x[1]), px, py, *_line_polar(parameters))
+    return np.array(((direction, dhx_01), (0., 1.)))
 
 def get_Dhn_line(x, parameters):
     p, theta, R, lidar_vector, n_gain = parameters
     return n_gain
 
+def h_inv_line_batch(zs, parameters):
+    """h_inv_line for an (N, 2) array of lines (rh, th) in the robot's frame."""
+    return _h_inv_line_batch_core(np.asarray(zs, dtype=np.float64), *_line_parameters(parameters))
+
+def h_line_batch(xs, parameters):
+    """h_line for an (N, 2) array of lines (rh, th) in the world frame."""
+    return _h_line_batch_core(np.asarray(xs, dtype=np.float64), *_line_parameters(parameters))
+
+def get_Dhx_line_batch(xs, parameters):
+    """get_Dhx_line for an (N, 2) array of lines, as an (N, 2, 2) array."""
+    px, py = _line_parameters(parameters)[0:2]
+    return _Dhx_line_batch_core(np.asarray(xs, dtype=np.float64), px, py, *_line_polar(parameters))
+
+def line_mahalanobis_sqr_batch(z, xs, covs, parameters, n_cov=None):
+    """Squared Mahalanobis distance of the observed line z = (rh, th) to the expected
+    observation of each of the (N, 2) lines xs with (N, 2, 2) covariances covs.
+
+    n_cov is the sensor noise covariance n_gain @ n_gain.T, computed from parameters if not given.
+    """
+    if n_cov is None:
+        n_gain = parameters[-1]
+        n_cov = n_gain @ n_gain.T
+    return _line_mahalanobis_sqr_batch_core(float(z[0]), float(z[1]), np.asarray(xs, dtype=np.float64),
+                                            np.asarray(covs, dtype=np.float64), *_line_parameters(parameters),
+                                            *_line_polar(parameters), float(n_cov[0, 0]), float(n_cov[0, 1]), float(n_cov[1, 1]))
+
+# Below this |det(Dhx)| the observation does not constrain the landmark's initial state
+_SINGULAR_DET = 1e-12
+
+@njit(cache=True, fastmath=True)
+def _init_cov_2x2(Dhx, Dhn):
+    """Initial covariance inv(Dhx) @ Dhn @ Dhn.T @ inv(Dhx).T for 2x2 jacobians,
+    or None if Dhx is singular."""
+    a, b, c, d = Dhx[0, 0], Dhx[0, 1], Dhx[1, 0], Dhx[1, 1]
+    det = a*d - b*c
+    if abs(det) < _SINGULAR_DET:
+        return None
+    # inv(Dhx) = adj / det, so cov = M @ M.T / det**2 with M = adj @ Dhn
+    adj = np.empty((2, 2))
+    adj[0, 0], adj[0, 1], adj[1, 0], adj[1, 1] = d, -b, -c, a
+    inv_det2 = 1 / det**2
+    M = np.zeros((2, 2))
+    for i in range(2):
+        for j in range(2):
+            for k in range(2):
+                M[i, j] += adj[i, k] * Dhn[k, j]
+    cov = np.zeros((2, 2))
+    for i in range(2):
+        for j in range(2):
+            for k in range(2):
+                cov[i, j] += M[i, k] * M[j, k]
+            cov[i, j] *= inv_det2
+    return cov
+
+@njit(cache=True, fastmath=True)
+def _init_cov_3x3(Dhx, Dhn):
+    """Initial covariance inv(Dhx) @ Dhn @ Dhn.T @ inv(Dhx).T for 3x3 jacobians,
+    or None if Dhx is singular."""
+    a, b, c = Dhx[0, 0], Dhx[0, 1], Dhx[0, 2]
+    d, e, f = Dhx[1, 0], Dhx[1, 1], Dhx[1, 2]
+    g, h, i = Dhx[2, 0], Dhx[2, 1], Dhx[2, 2]
+    A, B, C = e*i - f*h, f*g - d*i, d*h - e*g
+    det = a*A + b*B + c*C
+    if abs(det) < _SINGULAR_DET:
+        return None
+    # inv(Dhx) = adj / det, so cov = M @ M.T / det**2 with M = adj @ Dhn
+    adj = np.empty((3, 3))
+    adj[0, 0], adj[0, 1], adj[0, 2] = A, c*h - b*i, b*f - c*e
+    adj[1, 0], adj[1, 1], adj[1, 2] = B, a*i - c*g, c*d - a*f
+    adj[2, 0], adj[2, 1], adj[2, 2] = C, b*g - a*h, a*e - b*d
+    inv_det2 = 1 / det**2
+    M = np.zeros((3, 3))
+    for r in range(3):
+        for s in range(3):
+            for k in range(3):
+                M[r, s] += adj[r, k] * Dhn[k, s]
+    cov = np.zeros((3, 3))
+    for r in range(3):
+        for s in range(3):
+            for k in range(3):
+                cov[r, s] += M[r, k] * M[s, k]
+            cov[r, s] *= inv_det2
+    return cov
+
+def initial_covariance(Dhx: np.ndarray, Dhn: np.ndarray) -> np.ndarray | None:
+    """Covariance of a landmark first seen through a sensor with jacobians Dhx, Dhn,
+    inv(Dhx) @ Dhn @ Dhn.T @ inv(Dhx).T, or None if Dhx is (numerically) singular.
+
+    Uses closed form kernels for the usual 2x2 and 3x3 jacobians, where LAPACK
+    call overhead dominates the actual work, and a linear solve (rather than an
+    explicit inverse) otherwise.
+    """
+    if Dhx.shape == (2, 2) and Dhn.shape == (2, 2):
+        return _init_cov_2x2(Dhx, Dhn)
+    if Dhx.shape == (3, 3) and Dhn.shape == (3, 3):
+        return _init_cov_3x3(Dhx, Dhn)
+    if abs(np.linalg.det(Dhx)) < _SINGULAR_DET:
+        return None
+    M = np.linalg.solve(Dhx, Dhn)
+    return M @ M.T
+
+@functools.lru_cache(maxsize=None)
+def _n_stds(confidence_interval: float) -> float:
+    """Half width, in standard deviations, of the centered normal interval with the given probability."""
+    import scipy.stats
+    return -scipy.stats.norm.ppf((1-confidence_interval)/2)
+
+def _eig2x2_sym(C: np.ndarray) -> tuple[tuple[float, float], tuple[float, float]]:
+    """Closed form eigendecomposition of a symmetric 2x2 matrix.
+
+    Returns ((w0, w1), (vx, vy)), the eigenvalues in decreasing order and the
+    unit eigenvector of w0 (the one of w1 is orthogonal to it).
+    """
+    a, b, d = float(C[0, 0]), float(C[0, 1]), float(C[1, 1])
+    s = math.sqrt((a - d)*(a - d) + 4*b*b)
+    w0, w1 = (a + d + s) / 2, (a + d - s) / 2
+    norm = math.hypot(b, w0 - a)
+    if norm == 0:   # Diagonal, with a >= d
+        return (w0, w1), (1., 0.)
+    return (w0, w1), (b / norm, (w0 - a) / norm)
+
 @dataclass
 class LandmarkSettings(EKFSettings):
     """Settings for the EKF representing a landmark.
@@ -121,10 +336,30 @@ class Landmark(EKF):
     def __init__(self, settings: LandmarkSettings):
         super().__init__(settings)
         self.drawn = False
+        self._dirty = True  # changed since it was last drawn
         self.confidence_interval = 0.99 # draw ellipse for this confidence interval
         self.latest_zx = None
         self.seen_counter = 0
 
+    @property
+    def confidence_interval(self) -> float:
+        return self._confidence_interval
+
+    @confidence_interval.setter
+    def confidence_interval(self, confidence_interval: float):
+        self._confidence_interval = confidence_interval
+        # number of std's to include in confidence ellipse
+        self._n_stds = _n_stds(confidence_interval)
+        # ellipse axis length per unit std
+        self._ellipse_scale = 2*self._n_stds
+        self._dirty = True
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'confidence_interval' in state:
+            # Pickled when the confidence interval was a plain attribute: derive the drawing state
+            self.confidence_interval = self.__dict__.pop('confidence_interval')
+
     def predict(self):
         super().predict(u=0)
 
@@ -134,6 +369,15 @@ class Landmark(EKF):
         super().update(self.h(zx, parameters=parameters), **kwargs)
         self.latest_zx = zx
         self.seen_counter += 1
+        self._dirty = True
+
+    def set_updated_state(self, mu, cov, zx):
+        """Same as update(zx), for an update already computed elsewhere (resulting in mu and cov)."""
+        self.set_mu(mu)
+        self.set_cov(cov)
+        self.latest_zx = zx
+        self.seen_counter += 1
+        self._dirty = True
 
     def get_Mahalanobis_squared(self, z, diff=..., parameters=None, **kwargs):
         if parameters is not None:
@@ -145,6 +389,11 @@ class Landmark(EKF):
             super().set_parameters(parameters)
         return super().get_likelihood(z, diff, **kwargs)
 
+    def get_log_likelihood(self, z, diff=..., parameters = None, **kwargs):
+        if parameters is not None:
+            super().set_parameters(parameters)
+        return super().get_log_likelihood(z, diff, **kwargs)
+
     def _undraw(self):
         if self.drawn:
             self.drawn = False
@@ -168,29 +417,32 @@ class OrientedLandmark(Landmark):
         It also includes a marker for the mean of this distribution and another
         for the latest observation.
         """
-        if self.latest_zx is None:
+        if self.latest_zx is None or (self.drawn and not self._dirty):
             return
         p = self.get_mu()
         z = self.latest_zx
         if not self.drawn:
+            from matplotlib.collections import PathCollection
+            from matplotlib.patches import Ellipse
             self.drawn = True    
             self.std_ellipse: Ellipse = Ellipse((0, 0), 1, 1, facecolor='none', edgecolor=color_ellipse)
             ax.add_patch(self.std_ellipse)
             self.z_handle: PathCollection = ax.scatter(z[0], z[1], marker='1', c=color_z)
 
-        # number of std's to include in confidence ellipse
-        n_stds = -scipy.stats.norm.ppf((1-self.confidence_interval)/2)
+        scale = self._ellipse_scale
 
         # Plot ellipse
         self.std_ellipse.set_center(self.get_mu()[0:2])
-        [w, v] = np.linalg.eig(self.get_cov()[0:2, 0:2])
-        self.std_ellipse.set_width(np.sqrt(w[0])*n_stds*2)
-        self.std_ellipse.set_height(np.sqrt(w[1])*n_stds*2)
-        angle_deg = math.atan2(v[1, 0], v[0, 0]) * 180/np.pi
+        (w0, w1), (vx, vy) = _eig2x2_sym(self.get_cov()[0:2, 0:2])
+        # Rounding can leave the eigenvalues of a near singular covariance slightly negative
+        self.std_ellipse.set_width(math.sqrt(max(w0, 0.))*scale)
+        self.std_ellipse.set_height(math.sqrt(max(w1, 0.))*scale)
+        angle_deg = math.degrees(math.atan2(vy, vx))
         self.std_ellipse.set_angle(angle_deg)
 
         # Plot latest observation
         self.z_handle.set(offsets=z[0:2])
+        self._dirty = False
 
     def _rm_plt_info(self):
         super()._rm_plt_info()
@@ -206,29 +458,32 @@ class UnorientedLandmark(Landmark):
         It also includes a marker for the mean of this distribution and another
         for the latest observation.
         """
-        if self.latest_zx is None:
+        if self.latest_zx is None or (self.drawn and not self._dirty):
             return
         p = self.get_mu()
         z = self.latest_zx
         if not self.drawn:
+            from matplotlib.collections import PathCollection
+            from matplotlib.patches import Ellipse
             self.drawn = True    
             self.std_ellipse: Ellipse = Ellipse((0, 0), 1, 1, facecolor='none', edgecolor=color_ellipse)
             ax.add_patch(self.std_ellipse)
             self.z_handle: PathCollection = ax.scatter(p[0], p[1], marker='1', c=color_z)
 
-        # number of std's to include in confidence ellipse
-        n_stds = -scipy.stats.norm.ppf((1-self.confidence_interval)/2)
+        scale = self._ellipse_scale
 
         # Plot ellipse
         self.std_ellipse.set_center(self.get_mu())
-        [w, v] = np.linalg.eig(self.get_cov())
-        self.std_ellipse.set_width(np.sqrt(w[0])*n_stds*2)
-        self.std_ellipse.set_height(np.sqrt(w[1])*n_stds*2)
-        angle_deg = math.atan2(v[1, 0], v[0, 0]) * 180/np.pi
+        (w0, w1), (vx, vy) = _eig2x2_sym(self.get_cov())
+        # Rounding can leave the eigenvalues of a near singular covariance slightly negative
+        self.std_ellipse.set_width(math.sqrt(max(w0, 0.))*scale)
+        self.std_ellipse.set_height(math.sqrt(max(w1, 0.))*scale)
+        angle_deg = math.degrees(math.atan2(vy, vx))
         self.std_ellipse.set_angle(angle_deg)
 
         # Plot latest observation
         self.z_handle.set(offsets=p)
+        self._dirty = False
 
     def _rm_plt_info(self):
         super()._rm_plt_info()
@@ -242,21 +497,23 @@ class LineLandmark(Landmark):
         This drawing includes a line which is the estimate of the landmark's
         mean value.
         """
-        if self.latest_zx is None:
+        if self.latest_zx is None or (self.drawn and not self._dirty):
             return
         mu = self.get_mu()
         rh, th = mu
-        direction = np.array([np.sin(th), -np.cos(th)])
-        x0 = rh*np.array([np.cos(th), np.sin(th)])
-        points = np.array([x0 - direction, x0 + direction])
+        # Ends of a segment of the line, 1 unit away on each side of its closest point to the origin
+        c, s = math.cos(th), math.sin(th)
+        points = np.array([[rh*c - s, rh*s + c], [rh*c + s, rh*s - c]])
 
         if not self.drawn:
+            from matplotlib.lines import Line2D
             self.drawn = True    
             self.z_handle: Line2D = ax.plot(points[:, 0], points[:, 1], c=color_z)[0]
 
         # Plot latest observation
         self.z_handle.set_xdata(points[:, 0])
         self.z_handle.set_ydata(points[:, 1])
+        self._dirty = False
 
     def _undraw(self):
         if self.drawn:
@@ -271,13 +528,11 @@ class LandmarkType(Enum):
     ORIENTED = OrientedLandmark
     UNORIENTED = UnorientedLandmark
 
-def default_landmark_settings(type: LandmarkType):
-    """Returns the settings for the EKF representing an observation.
-    
-    The observation is represented by its position in the xy plane, as well as an orientation.
-    By default, there is a linear measurement model, but this can be
-    changed by setting the `h` and `Dh_` functions at measurement time.
-    """
+# Enum .value goes through a descriptor on every access
+_LANDMARK_CLS = {type: type.value for type in LandmarkType if type is not LandmarkType.MISSING_TYPE}
+
+@functools.lru_cache(maxsize=None)
+def _landmark_settings_template(type: LandmarkType):
     def whatsthisobservation():
         raise ValueError("Observation type unknown or unset")
     vals = {
@@ -288,7 +543,22 @@ def default_landmark_settings(type: LandmarkType):
     }
     return vals[type]()
 
-@dataclass
+def default_landmark_settings(type: LandmarkType):
+    """Returns the settings for the EKF representing an observation.
+    
+    The observation is represented by its position in the xy plane, as well as an orientation.
+    By default, there is a linear measurement model, but this can be
+    changed by setting the `h` and `Dh_` functions at measurement time.
+
+    The settings are a shallow copy of one template per type, so assign new
+    arrays to them rather than modifying them in place.
+    """
+    return copy.copy(_landmark_settings_template(type))
+
+def _unset_model(*args):
+    # user needs to set h, h_inv, get_Dhx and get_Dhn, the defaults only exist for inheritance reasons
+    raise ValueError("Observation model unset")
+
 class Observation:
     """ Observation of a landmark base class.
     Observation model:
@@ -300,79 +570,172 @@ class Observation:
         z - observations (known)
 
         h - invertible and differentiable function
+
+    Observations are created for every measurement, so they are plain
+    __slots__ classes rather than dataclasses.
     """
-    landmark_id: int
-    z: np.ndarray
-    h: callable
-    h_inv: callable
-    get_Dhx: callable
-    get_Dhn: callable
-    landmark_type: LandmarkType = field(default=LandmarkType.MISSING_TYPE, init=False)
+    __slots__ = ('landmark_id', 'z', 'h', 'h_inv', 'get_Dhx', 'get_Dhn')
+    type: LandmarkType = LandmarkType.MISSING_TYPE
+
+    def __init__(self, landmark_id: int, z: np.ndarray, h: callable, h_inv: callable, get_Dhx: callable,
+                 get_Dhn: callable) -> None:
+        self.landmark_id = landmark_id
+        self.z = z
+        self.h = h
+        self.h_inv = h_inv
+        self.get_Dhx = get_Dhx
+        self.get_Dhn = get_Dhn
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(landmark_id={self.landmark_id!r}, z={self.z!r})'
     
 
-@dataclass
 class UnorientedObservation(Observation):
     """ Observation of an unoriented landmark
     """
-    landmark_id: int = 0
-    z: np.ndarray = np.array([0, 0]) 
-    h: callable = lambda x, n: 1/0 # user needs to set this, but it requires a default value for dataclass inheritance reasons
-    h_inv: callable = lambda z: 1/0
-    get_Dhx: callable = lambda x, n: 1/0
-    get_Dhn: callable = lambda x, n: 1/0
-    type: LandmarkType = field(default=LandmarkType.UNORIENTED, init=False)
+    __slots__ = ()
+    type: LandmarkType = LandmarkType.UNORIENTED
+
+    def __init__(self, landmark_id: int = 0, z: np.ndarray = np.array([0, 0]), h: callable = _unset_model,
+                 h_inv: callable = _unset_model, get_Dhx: callable = _unset_model,
+                 get_Dhn: callable = _unset_model) -> None:
+        super().__init__(landmark_id, z, h, h_inv, get_Dhx, get_Dhn)
+
+class LineObservation(Observation):
+    """
+    Observation of a line.
+    """
+    __slots__ = ()
+    type: LandmarkType = LandmarkType.LINE
+
+    def __init__(self, landmark_id: int = 0, z: np.ndarray = np.array([0, 0]), h: callable = _unset_model,
+                 h_inv: callable = _unset_model, get_Dhx: callable = _unset_model,
+                 get_Dhn: callable = _unset_model) -> None:
+        super().__init__(landmark_id, z, h, h_inv, get_Dhx, get_Dhn)
 
-@dataclass
 class Observation(Observation):
     """ Observation of an oriented landmark.
     """
-    landmark_id: int = 0
-    z: np.ndarray = np.array([0, 0, 0])
-    h: callable = lambda x, n: 1/0
-    h_inv: callable = lambda z: 1/0
-    get_Dhx: callable = lambda x, n: 1/0
-    get_Dhn: callable = lambda x, n: 1/0
-    type: LandmarkType = field(default=LandmarkType.ORIENTED, init=False)
+    __slots__ = ()
+    type: LandmarkType = LandmarkType.ORIENTED
 
-@dataclass
-class LineObservation():
-    """
-    Observation of a line.
+    def __init__(self, landmark_id: int = 0, z: np.ndarray = np.array([0, 0, 0]), h: callable = _unset_model,
+                 h_inv: callable = _unset_model, get_Dhx: callable = _unset_model,
+                 get_Dhn: callable = _unset_model) -> None:
+        super().__init__(landmark_id, z, h, h_inv, get_Dhx, get_Dhn)
+
+class LandmarkStack:
+    """Means, covariances and update counts of all landmarks of one type, as
+    contiguous arrays (one row per landmark, in insertion order).
+
+    Kept in sync with the landmarks' filters by Map.update, so that batched
+    computations over all landmarks read these instead of every Landmark.
     """
-    landmark_id: int = 0
-    z: np.ndarray = np.array([0, 0])
-    h: callable = lambda x, n: 1/0
-    h_inv: callable = lambda z: 1/0
-    get_Dhx: callable = lambda x, n: 1/0
-    get_Dhn: callable = lambda x, n: 1/0
-    type: LandmarkType = field(default=LandmarkType.LINE, init=False)
+    def __init__(self, dim: int, capacity: int = 8) -> None:
+        self.ids: list[int] = []
+        self.id_to_idx: dict[int, int] = {}
+        self._mus = np.empty((capacity, dim))
+        self._covs = np.empty((capacity, dim, dim))
+        self._seen = np.zeros((capacity,), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def mus(self) -> np.ndarray:
+        return self._mus[:len(self.ids)]
+
+    @property
+    def covs(self) -> np.ndarray:
+        return self._covs[:len(self.ids)]
+
+    @property
+    def seen(self) -> np.ndarray:
+        return self._seen[:len(self.ids)]
+
+    def append(self, landmark_id: int, landmark: Landmark) -> None:
+        idx = len(self.ids)
+        if idx == len(self._mus):
+            # Grow geometrically, like a list
+            self._mus = np.concatenate([self._mus, np.empty_like(self._mus)])
+            self._covs = np.concatenate([self._covs, np.empty_like(self._covs)])
+            self._seen = np.concatenate([self._seen, np.zeros_like(self._seen)])
+        self.ids.append(landmark_id)
+        self.id_to_idx[landmark_id] = idx
+        self.set(landmark_id, landmark)
+
+    def set(self, landmark_id: int, landmark: Landmark) -> None:
+        idx = self.id_to_idx[landmark_id]
+        self._mus[idx] = landmark.get_mu()
+        self._covs[idx] = landmark.get_cov()
+        self._seen[idx] = landmark.seen_counter
+
+    def copy(self) -> 'LandmarkStack':
+        new_stack = object.__new__(LandmarkStack)
+        new_stack.ids = self.ids.copy()
+        new_stack.id_to_idx = self.id_to_idx.copy()
+        new_stack._mus = self._mus.copy()
+        new_stack._covs = self._covs.copy()
+        new_stack._seen = self._seen.copy()
+        return new_stack
 
 class Map:
     def __init__(self) -> None:
         self.landmarks: dict[int, Landmark] = {}
+        self.stacks: dict[LandmarkType, LandmarkStack] = {}
+
+    def stack(self, type: LandmarkType) -> LandmarkStack:
+        """Landmarks of the given type as contiguous arrays. See LandmarkStack."""
+        if type not in self.stacks:
+            dim = 3 if type is LandmarkType.ORIENTED else 2
+            self.stacks[type] = LandmarkStack(dim)
+        return self.stacks[type]
 
     def update(self, obs: Observation, diff = lambda x, y: x-y, parameters = None):
-        if obs.landmark_id not in self.landmarks:
+        """Adds the observation to the map.
+
+        Returns the log likelihood of the observation given the landmark's previous
+        state, or None if the observation created a new landmark (or would have, but
+        does not constrain its initial state). Observations of known landmarks are
+        never rejected, so callers cannot tell beforehand whether to skip one.
+        """
+        landmark = self.landmarks.get(obs.landmark_id)
+        if landmark is None:
             x0 = obs.h_inv(obs.z, parameters)
-            Dhn = obs.get_Dhn(x0, parameters)
-            Dhx_inv = np.linalg.inv(obs.get_Dhx(x0, parameters))
+            Dhn = np.asarray(obs.get_Dhn(x0, parameters), dtype=np.float64)
+            Dhx = np.asarray(obs.get_Dhx(x0, parameters), dtype=np.float64)
+            cov0 = initial_covariance(Dhx, Dhn)
+            if cov0 is None:
+                # Creating the landmark would start its EKF from an infinite covariance
+                return None
             landmark_settings = default_landmark_settings(obs.type)
             landmark_settings.mu0 = x0
-            landmark_settings.cov0 = Dhx_inv @ Dhn @ Dhn.T @ Dhx_inv.T
+            landmark_settings.cov0 = cov0
 
-            self.landmarks[obs.landmark_id] = obs.type.value(landmark_settings)
-            self.landmarks[obs.landmark_id].set_sensor_model(obs.h, obs.get_Dhx, obs.get_Dhn)
+            landmark = self.landmarks[obs.landmark_id] = _LANDMARK_CLS[obs.type](landmark_settings)
+            landmark.set_sensor_model(obs.h, obs.get_Dhx, obs.get_Dhn)
+            self.stack(obs.type).append(obs.landmark_id, landmark)
             return None
         else:
-            #self.landmarks[obs.landmark_id].set_sensor_model(obs.h, obs.get_Dhx, obs.get_Dhn)
-            likelyhood = self.landmarks[obs.landmark_id].get_likelihood(obs.z, diff=diff, parameters=parameters, normalize=False)
-            self.landmarks[obs.landmark_id].update(obs.h_inv(obs.z, parameters=parameters), diff=diff, parameters=parameters)
-            return likelyhood
+            #landmark.set_sensor_model(obs.h, obs.get_Dhx, obs.get_Dhn)
+            log_likelihood = landmark.get_log_likelihood(obs.z, diff=diff, parameters=parameters, normalize=False)
+            landmark.update(obs.h_inv(obs.z, parameters=parameters), diff=diff, parameters=parameters)
+            self.stack(obs.type).set(obs.landmark_id, landmark)
+            return log_likelihood
+
+    def set_landmark_state(self, type: LandmarkType, landmark_id: int, mu: np.ndarray, cov: np.ndarray,
+                           zx: np.ndarray) -> None:
+        """Stores the outcome of an update of an existing landmark computed outside its filter
+        (e.g. for many maps at once), keeping the landmark stack in sync.
+        """
+        landmark = self.landmarks[landmark_id]
+        landmark.set_updated_state(mu, cov, zx)
+        self.stack(type).set(landmark_id, landmark)
 
     def _draw(self, ax, **plot_kwargs):
-        for landmark_id in self.landmarks:
-            if self.landmarks[landmark_id].seen_counter > 10:
-                self.landmarks[landmark_id]._draw(ax, **plot_kwargs)
+        for stack in self.stacks.values():
+            for idx in np.flatnonzero(stack.seen > 10):
+                self.landmarks[stack.ids[idx]]._draw(ax, **plot_kwargs)
 
     def _undraw(self):
         for landmark_id in self.landmarks:
@@ -384,11 +747,38 @@ class Map:
         return self
 
     def copy(self):
-        return copy.copy(self)
+        """Copy of the map whose landmarks can be updated independently of this one's.
+
+        Landmarks are copied shallowly, as their filters replace (never modify)
+        their arrays on each update, and without their plot handles.
+        """
+        new_map = Map()
+        landmarks = new_map.landmarks
+        for landmark_id, landmark in self.landmarks.items():
+            new_landmark = object.__new__(type(landmark))
+            state = landmark.__dict__.copy()
+            state['drawn'] = False
+            state.pop('std_ellipse', None)
+            state.pop('z_handle', None)
+            new_landmark.__dict__ = state
+            landmarks[landmark_id] = new_landmark
+        new_map.stacks = {type: stack.copy() for type, stack in self.stacks.items()}
+        return new_map
+
+    __copy__ = copy
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'stacks' not in state:
+            # Pickled before maps kept their landmark stacks, rebuild them
+            self.stacks = {}
+            for landmark_id, landmark in self.landmarks.items():
+                self.stack(LandmarkType(type(landmark))).append(landmark_id, landmark)
 
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
+    from visualization_utils.mpl_video import to_video
 
     rng = np.random.default_rng(0)
 
@@ -466,42 +856,50 @@ if __name__ == '__main__':
     plt.xlabel("x [m]")
     plt.ylabel("y [m]")
     
+    # Sensor model, parameters = (p, R, n_gain) for the robot at p with world to robot rotation R
+    def h(x, parameters):    # z is observed position of landmark in robot's reference frame
+        p, R, n_gain = parameters
+        return R @ (x - p)
+
+    def h_noisy(x, n, parameters):
+        p, R, n_gain = parameters
+        z_no_noise = h(x, parameters)
+        r_err, ang_err = n_gain @ n
+        c_err, s_err = math.cos(ang_err), math.sin(ang_err)
+        R_error = np.array([[c_err, s_err], [-s_err, c_err]])
+        return (1 + (r_err/np.linalg.norm(z_no_noise))) * R_error @ z_no_noise
+
+    def h_inv(z, parameters):
+        p, R, n_gain = parameters
+        return R.T @ z + p
+
+    def get_Dhx(x, parameters):
+        p, R, n_gain = parameters
+        return R
+
+    def get_Dhn(x, parameters):
+        p, R, n_gain = parameters
+        z = R @ (x - p)
+        return np.array([[z[0], -z[1]], [z[1], z[0]]]) @ n_gain
+
     for i, pose in enumerate(poses):
         px, py, theta = pose
         px *= a
         py *= a
-        plt.scatter(px, py, marker=(3, 0, theta*180/np.pi-90), c='r')
-
-        p = np.array([px, py])
-        R = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
-        
-        def h(x, n):    # z is observed position of landmark in robot's reference frame
-            z_no_noise = R @ (x - p)
-            r_err, ang_err = n_gain @ n
-            R_error = np.array([[np.cos(ang_err), np.sin(ang_err)], [-np.sin(ang_err), np.cos(ang_err)]])
-            return (1 + (r_err/np.linalg.norm(z_no_noise))) * R_error @ z_no_noise
-
-        def h_inv(z):
-            return R.T @ z + p
-
-        def get_Dhx(x):
-            return R
-
-        def get_Dhn(x):
-            z = R @ (x - p)
-            return np.array([[z[0], -z[1]], [z[1], z[0]]]) @ n_gain
-        landmark_id = 0
+        plt.scatter(px, py, marker=(3, 0, math.degrees(theta)-90), c='r')
 
+        c, s = math.cos(theta), math.sin(theta)
+        parameters = (np.array([px, py]), np.array([[c, s], [-s, c]]), n_gain)
 
         # make an observation with noise
-        z = h(x_real_landmark_0, rng.normal(size=(2,)))
+        z = h_noisy(x_real_landmark_0, rng.normal(size=(2,)), parameters)
         obs1 = UnorientedObservation(landmark_id=0, z=z, h=h, h_inv=h_inv, get_Dhx=get_Dhx, get_Dhn=get_Dhn)
-        map.update(obs1)
+        map.update(obs1, parameters=parameters)
 
         # make an observation with noise
-        z = h(x_real_landmark_1, rng.normal(size=(2,)))
+        z = h_noisy(x_real_landmark_1, rng.normal(size=(2,)), parameters)
         obs2 = UnorientedObservation(landmark_id=1, z=z, h=h, h_inv=h_inv, get_Dhx=get_Dhx, get_Dhn=get_Dhn)
-        map.update(obs2)
+        map.update(obs2, parameters=parameters)
 
         map._draw(ax)
         plt.pause(0.01)
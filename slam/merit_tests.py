@@ -1,6 +1,7 @@
 from __future__ import annotations
 from cmath import inf
 import os
+import math
 import matplotlib.pyplot as plt
 import numpy as np
 import pickle
@@ -15,7 +16,7 @@ import slam.mass as mass
 def plot_map(estimated_map: sm.Map, trajectory: list[tuple[int, np.ndarray]], sensor_data: sd.SensorData, ax: plt.Axes,
              t0: float = 0, tf: float = np.inf):
     t_traj = np.array([traj[0] for traj in trajectory]) 
-    t_lid = (np.array([lid[0] for lid in sensor_data.lidar]) - sensor_data.lidar[0][0])*1e-9
+    t_lid = (sensor_data.lidar_ts - sensor_data.lidar_ts[0])*1e-9
 
     pc_plot_handle: plt.Line2D = ax.plot([], [], markersize=0.1, linestyle='', marker='.', c='#000000', zorder=-10)[0]
 
@@ -110,16 +111,15 @@ def traj_mse(slam_result: fs.SLAMResult):
     actual_trajectory: list[tuple[float, np.ndarray]] = slam_result.actual_trajectory
     estimated_trajectory: list[tuple[float, np.ndarray]] = slam_result.trajectory
 
-    def diff_t2(rh_th1_actual, rh_th2):
-        return np.block([rh_th1_actual[:2] - rh_th2[:2], (np.mod(rh_th1_actual[2]*np.pi/180 - rh_th2[2] + np.pi, 2*np.pi) - np.pi)*180/np.pi])
-
     if len(actual_trajectory) != len(estimated_trajectory):
         raise ValueError(f"Actual trajectory and estimated trajectory have different lengths ({len(actual_trajectory)} and {len(estimated_trajectory)})")
     
     errorxyt = np.zeros((len(actual_trajectory), 3))
     time = np.zeros((len(actual_trajectory),))
     for idx, ((t, actual_pose), (_, estimated_pose)) in enumerate(zip(actual_trajectory, estimated_trajectory)):
-        errorxyt[idx, :] = diff_t2(actual_pose, estimated_pose) # x
+        errorxyt[idx, :2] = actual_pose[:2] - estimated_pose[:2]
+        # Actual heading is in degrees, the error is reported in degrees as well
+        errorxyt[idx, 2] = math.degrees(math.remainder(math.radians(actual_pose[2]) - estimated_pose[2], 2*math.pi))
         time[idx] = t
     
     rmsexyt = np.sqrt(np.square(errorxyt).mean(axis=0))
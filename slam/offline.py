@@ -1,5 +1,6 @@
 from __future__ import annotations
 import os
+import math
 import shutil
 import time
 import copy
@@ -24,6 +25,24 @@ def there_is_data(data: sd.SensorData, idx_lidar, idx_camera, idx_odometry):
     return idx_lidar < len(data.lidar) or idx_camera < len(data.camera) or idx_odometry < len(data.odometry)
 
 
+def next_time(stream, idx, t0_ros):
+    return stream[idx][0] - t0_ros if idx < len(stream) else np.inf
+
+
+def next_event(t_lidar, t_camera, t_odo):
+    ''' Selects the stream with the earliest next sample (ties go to lidar, then camera).
+
+        Returns:
+            it - 0 for lidar, 1 for camera, 2 for odometry
+            t - time of that sample [s]
+    '''
+    if t_lidar <= t_camera and t_lidar <= t_odo:
+        return 0, t_lidar/1e9
+    if t_camera <= t_odo:
+        return 1, t_camera/1e9
+    return 2, t_odo/1e9
+
+
 def plot_pc(pc_plot_handle, scan: np.ndarray, pose: np.ndarray):
     ''' Adds new scan to point cloud map. 
 
@@ -97,18 +116,16 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
     
     if not data.camera:
         data.camera = [(max([data.lidar[-1][0], data.odometry[-1][0]]) + 100, (None, None, None))]
-    t0_ros = [data.lidar[i+1][0], data.camera[j+1][0], data.odometry[k+1][0]
-              ][np.argmin([data.lidar[i+1][0], data.camera[j+1][0], data.odometry[k+1][0]])]
-    total_time = ([data.lidar[-1][0], data.camera[-1][0], data.odometry[-1][0]
-              ][np.argmax([data.lidar[-1][0], data.camera[-1][0], data.odometry[-1][0]])] - t0_ros)/1e9
+    t0_ros = min(data.lidar[i+1][0], data.camera[j+1][0], data.odometry[k+1][0])
+    total_time = (max(data.lidar[-1][0], data.camera[-1][0], data.odometry[-1][0]) - t0_ros)/1e9
     if total_time > final_time:
         total_time = final_time
 
-    def next_times():
-        tlidar = data.lidar[i+1][0] if i+1 < len(data.lidar) else np.inf
-        tcamera = data.camera[j+1][0] if j+1 < len(data.camera) else np.inf
-        tod = data.odometry[k+1][0] if k+1 < len(data.odometry) else np.inf
-        return [tlidar-t0_ros, tcamera-t0_ros, tod-t0_ros]
+    # Time of the next unprocessed sample of each stream, relative to t0_ros
+    t_lidar = next_time(data.lidar, i+1, t0_ros)
+    t_camera = next_time(data.camera, j+1, t0_ros)
+    t_odo = next_time(data.odometry, k+1, t0_ros)
+    prev_odom = data.odometry[k][1]
 
     it = -1
     t0 = time.time()
@@ -142,12 +159,10 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
 
             if realtime:
                 last_t = t if it >= 0 else t0_ros
-                it = np.argmin(next_times())
-                t = next_times()[it]/1e9
+                it, t = next_event(t_lidar, t_camera, t_odo)
                 time.sleep(max(0, (t-last_t)/1e9 - (time.time() - t0)))
             else:
-                it = np.argmin(next_times())
-                t = next_times()[it]/1e9
+                it, t = next_event(t_lidar, t_camera, t_odo)
 
             if data.sim_data is not None:
                 sim_i = round(t/ts)
@@ -165,6 +180,7 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
                 dt_save.append(0)
             if it == 0:  # Lidar data incoming
                 i += 1
+                t_lidar = next_time(data.lidar, i+1, t0_ros)
                 if t < start_time or t > final_time:
                     continue
                 scan = data.lidar[i][1]
@@ -177,6 +193,7 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
 
             elif it == 1:  # Camera data incoming
                 j += 1
+                t_camera = next_time(data.camera, j+1, t0_ros)
                 if t < start_time or t > final_time:
                     continue
                 if len(data.camera[j]) != 3:
@@ -186,25 +203,24 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
                     cam_ax.clear()
                     Img = cv2.imdecode(CmpImg, cv2.IMREAD_COLOR)
                     cam_ax.imshow(cv2.cvtColor(Img, cv2.COLOR_BGR2RGB))
-                for id, z in landmarks:
-                    r, theta, psi = z
-                    #slammer.make_unoriented_observation(t, (id, np.array([r, theta])))
-                    #slammer.make_oriented_observation(t, (id, np.array([r, theta, psi])))
+                # Each z is already an [r, theta, psi] row of the frame's measurement block
+                #for id, z in landmarks:
+                #    slammer.make_unoriented_observation(t, (id, z[:2]))
+                #    slammer.make_oriented_observation(t, (id, z))
 
                 if profile:
                     dt_camera[-1] = time.time() - t0
             elif it == 2:  # Odometry data incoming
                 k += 1
+                t_odo = next_time(data.odometry, k+1, t0_ros)
+                theta0, x0, y0 = prev_odom
+                prev_odom = theta1, x1, y1 = data.odometry[k][1]
                 if t < start_time or t > final_time:
                     continue
-                theta0, x0, y0 = data.odometry[k-1][1]
-                theta1, x1, y1 = data.odometry[k][1]
-                pos_diff = np.array([x1-x0, y1-y0]).flatten()
                 # Rotate to frame of odom0 to use only relative info
-                R = np.array([[np.cos(-theta0), -np.sin(-theta0)], [np.sin(-theta0), np.cos(-theta0)]]).squeeze()
-                pos_diff = R @ pos_diff
-                odom = np.block([pos_diff, theta1-theta0])
-                odom[2] = np.mod(odom[2] + np.pi, 2*np.pi) - np.pi
+                dx, dy = x1-x0, y1-y0
+                c, s = math.cos(theta0), math.sin(theta0)
+                odom = np.array([c*dx + s*dy, c*dy - s*dx, math.remainder(theta1-theta0, 2*math.pi)])
 
                 slammer.resample()
                 if data.sim_data is not None:
@@ -232,32 +248,31 @@ def slam_sensor_data(data: sd.SensorData, slam_settings: fs.FastSLAMSettings = f
             tf = time.time()
             if profile:
                 dt_iter.append(tf - t0)
-                # Means only of iterations where operation was executed
-                t_iter_mean = np.mean(dt_iter)
-                t_sel_mean = np.mean(dt_sel)
-                with warnings.catch_warnings():
-                    # Mean of empty slices returns nan and causes these warnings
-                    # Replace nan with 0
-                    warnings.filterwarnings('ignore', r'Mean of empty slice.')
-                    warnings.filterwarnings('ignore', r'invalid value encountered in double_scalars')
-                    t_lidar_mean = np.nan_to_num(np.mean([dt for dt in dt_lidar if dt != 0]))
-                    t_cam_mean = np.nan_to_num(np.mean([dt for dt in dt_camera if dt != 0]))
-                    t_odom_mean = np.nan_to_num(np.mean([dt for dt in dt_odometry if dt != 0]))
-                    t_draw_mean = np.nan_to_num(np.mean([dt for dt in dt_draw if dt != 0]))
-                    t_save_mean = np.nan_to_num(np.mean([dt for dt in dt_save if dt != 0]))
-
-                # Percentages counting all iterations
-                t_iter_total = np.sum(dt_iter)
-                t_sel_percentage = 100*np.sum(dt_sel)/t_iter_total
-                t_lidar_percentage = 100*np.sum(dt_lidar)/t_iter_total
-                t_cam_percentage = 100*np.sum(dt_camera)/t_iter_total
-                t_odom_percentage = 100*np.sum(dt_odometry)/t_iter_total
-                t_draw_percentage = 100*np.sum(dt_draw)/t_iter_total
-                t_save_percentage = 100*np.sum(dt_save)/t_iter_total
-
-            if profile:
                 if tf - print_last_t > 0.5:
                     print_last_t = tf
+                    # Means only of iterations where operation was executed
+                    t_iter_mean = np.mean(dt_iter)
+                    t_sel_mean = np.mean(dt_sel)
+                    with warnings.catch_warnings():
+                        # Mean of empty slices returns nan and causes these warnings
+                        # Replace nan with 0
+                        warnings.filterwarnings('ignore', r'Mean of empty slice.')
+                        warnings.filterwarnings('ignore', r'invalid value encountered in double_scalars')
+                        t_lidar_mean = np.nan_to_num(np.mean([dt for dt in dt_lidar if dt != 0]))
+                        t_cam_mean = np.nan_to_num(np.mean([dt for dt in dt_camera if dt != 0]))
+                        t_odom_mean = np.nan_to_num(np.mean([dt for dt in dt_odometry if dt != 0]))
+                        t_draw_mean = np.nan_to_num(np.mean([dt for dt in dt_draw if dt != 0]))
+                        t_save_mean = np.nan_to_num(np.mean([dt for dt in dt_save if dt != 0]))
+
+                    # Percentages counting all iterations
+                    t_iter_total = np.sum(dt_iter)
+                    t_sel_percentage = 100*np.sum(dt_sel)/t_iter_total
+                    t_lidar_percentage = 100*np.sum(dt_lidar)/t_iter_total
+                    t_cam_percentage = 100*np.sum(dt_camera)/t_iter_total
+                    t_odom_percentage = 100*np.sum(dt_odometry)/t_iter_total
+                    t_draw_percentage = 100*np.sum(dt_draw)/t_iter_total
+                    t_save_percentage = 100*np.sum(dt_save)/t_iter_total
+
                     # \033[<N> A move cursor N lines up; \033[K clear until end of line
                     print(
                         f"Iteration {i+j+k:06d}: Averages [ms]: total:{int(1000*t_iter_mean):04d} sel:{int(1000*t_sel_mean):04d}"
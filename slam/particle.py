@@ -1,33 +1,129 @@
 from __future__ import annotations
-from cmath import inf
+import math
 
-from typing import Callable
-import copy
-from unicodedata import ucd_3_2_0
+from typing import TYPE_CHECKING, Callable
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-from slam.map import OrientedLandmarkSettings, Map, Observation, UnorientedObservation, LineObservation, get_Dhn_line, get_Dhx_line, h_inv_line, h_line
+if TYPE_CHECKING:
+    # Only drawing needs matplotlib, whose import is slow; SLAM itself does not
+    import matplotlib.pyplot as plt
 
-import scipy.stats
-import time
+from ekf.ekf import _LOG_PDF_FLOOR, _LOG_PDF_UNDERFLOW
+from math_extra import njit, wrap_angle
+from slam.map import Map, LandmarkType, Observation, UnorientedObservation, LineObservation, LineParameters, get_Dhn_line, get_Dhx_line, h_inv_line, h_line, \
+    line_mahalanobis_sqr_batch
+
+# The sensor models below run for every landmark observation of every particle. Their
+# math is in numba kernels; the public functions only unpack `parameters`
+
+@njit(cache=True, fastmath=True)
+def _diff_wrap(a, b, angle_idx):
+    d = a - b
+    d[angle_idx] = wrap_angle(d[angle_idx])
+    return d
 
 def diff_t1(rh_th1, rh_th2):
-    return np.array([rh_th1[0] - rh_th2[0], np.mod(rh_th1[1] - rh_th2[1] + np.pi, 2*np.pi) - np.pi])
+    return _diff_wrap(rh_th1, rh_th2, 1)
 
 def diff_t2(rh_th1, rh_th2):
-    return np.block([rh_th1[:2] - rh_th2[:2], np.mod(rh_th1[2] - rh_th2[2] + np.pi, 2*np.pi) - np.pi])
+    return _diff_wrap(rh_th1, rh_th2, 2)
+
+
+@njit(cache=True, fastmath=True)
+def _h_uo_core(x, p, R):
+    # R @ (x - p)
+    dx, dy = x[0] - p[0], x[1] - p[1]
+    z = np.empty(2)
+    z[0] = R[0, 0]*dx + R[0, 1]*dy
+    z[1] = R[1, 0]*dx + R[1, 1]*dy
+    return z
+
+@njit(cache=True, fastmath=True)
+def _h_inv_uo_core(z, p, R):
+    # R.T @ z + p
+    x = np.empty(2)
+    x[0] = R[0, 0]*z[0] + R[1, 0]*z[1] + p[0]
+    x[1] = R[0, 1]*z[0] + R[1, 1]*z[1] + p[1]
+    return x
+
+@njit(cache=True, fastmath=True)
+def _Dhn_uo_core(x, p, R, n_gain):
+    # [[z0, -z1], [z1, z0]] @ n_gain, with z = R @ (x - p)
+    z = _h_uo_core(x, p, R)
+    Dh = np.empty((2, 2))
+    for j in range(2):
+        Dh[0, j] = z[0]*n_gain[0, j] - z[1]*n_gain[1, j]
+        Dh[1, j] = z[1]*n_gain[0, j] + z[0]*n_gain[1, j]
+    return Dh
+
+@njit(cache=True, fastmath=True)
+def _h_o_core(x, p, theta, R):
+    z = np.empty(3)
+    z[0:2] = _h_uo_core(x, p, R)
+    z[2] = x[2] - theta
+    return z
+
+@njit(cache=True, fastmath=True)
+def _h_inv_o_core(z, p, theta, R):
+    x = np.empty(3)
+    x[0:2] = _h_inv_uo_core(z, p, R)
+    x[2] = z[2] + theta
+    return x
+
+@njit(cache=True, fastmath=True)
+def _Dhx_o_core(R):
+    Dh = np.zeros((3, 3))
+    Dh[0:2, 0:2] = R
+    Dh[2, 2] = 1
+    return Dh
+
+@njit(cache=True, fastmath=True)
+def _Dhn_o_core(x, p, R, n_gain):
+    Dh = np.zeros((3, 3))
+    Dh[0:2, 0:2] = _Dhn_uo_core(x, p, R, n_gain)
+    Dh[2, 2] = n_gain[2, 2]
+    return Dh
+
+
+@njit(cache=True, fastmath=True)
+def _oriented_update_batch_core(z, poses, mus, covs, n_gain):
+    """EKF update (Landmark.update) of one oriented landmark per pose with the observation z.
+
+    Returns the landmarks' updated means and covariances, the observed landmark position
+    from each pose and the unnormalized log likelihood of z given each landmark.
+    """
+    n = poses.shape[0]
+    new_mus, new_covs = np.empty_like(mus), np.empty_like(covs)
+    zxs, log_likelihoods = np.empty_like(mus), np.empty(n)
+    for i in range(n):
+        # Same frame as Particle._pose_frame, transposed as the oriented model takes it
+        theta = poses[i, 2]
+        c, s = math.cos(theta), math.sin(theta)
+        p = poses[i, 0:2]
+        R = np.array([[c, s], [-s, c]])
+        mu, cov = mus[i], covs[i]
+        Dhx = _Dhx_o_core(R)
+        Dhn = _Dhn_o_core(mu, p, R, n_gain)
+        inv_z_cov = np.linalg.inv(Dhx @ cov @ Dhx.T + Dhn @ Dhn.T)
+        d = _diff_wrap(z, _h_o_core(mu, p, theta, R), 2)
+        log_likelihoods[i] = -1/2 * (d @ inv_z_cov @ d)
+        # The filter is updated with h(h_inv(z)), as in Map.update
+        zx = _h_inv_o_core(z, p, theta, R)
+        K = cov @ Dhx.T @ inv_z_cov
+        new_mus[i] = mu + K @ _diff_wrap(_h_o_core(zx, p, theta, R), _h_o_core(mu, p, theta, R), 2)
+        new_covs[i] = cov - K @ Dhx @ cov
+        zxs[i] = zx
+    return new_mus, new_covs, zxs, log_likelihoods
 
 
 def h_uo(x, parameters):    # z is observed position of landmark in robot's reference frame
     p, R, n_gain = parameters
-    z_no_noise = R @ (x - p)
-    return z_no_noise
+    return _h_uo_core(x, p, R)
 
 def h_inv_uo(z, parameters):
     p, R, n_gain = parameters
-    return R.T @ z + p
+    return _h_inv_uo_core(z, p, R)
 
 def get_Dhx_uo(x, parameters):
     p, R, n_gain = parameters
@@ -35,40 +131,30 @@ def get_Dhx_uo(x, parameters):
 
 def get_Dhn_uo(x, parameters):
     p, R, n_gain = parameters
-    z = R @ (x - p)
-    return np.array([[z[0], -z[1]], [z[1], z[0]]]) @ n_gain
+    return _Dhn_uo_core(x, p, R, n_gain)
         
 def h_o(x, parameters):    # z is observed position of landmark in robot's reference frame
     p, theta, R, n_gain = parameters
-    x_prime = x[0:2]
-    psi_prime = x[2]
-    z_no_noise = R @ (x_prime - p)
-    z_psi_no_noise = psi_prime - theta
-    return np.block([z_no_noise, z_psi_no_noise ])
+    return _h_o_core(x, p, theta, R)
 
 def h_inv_o(z, parameters):
     p, theta, R, n_gain = parameters
-    z_prime = z[0:2]
-    z_psi = z[2]
-    return np.array([*(R.T @ z_prime + p), z_psi + theta])
+    return _h_inv_o_core(z, p, theta, R)
 
 def get_Dhx_o(x, parameters):
     p, theta, R, n_gain = parameters
-    Dh = np.zeros((3,3))
-    Dh[0:2, 0:2] = R
-    Dh[2, 2] = 1
-    return Dh
+    return _Dhx_o_core(R)
 
 def get_Dhn_o(x, parameters):
     p, theta, R, n_gain = parameters
-    Dh = np.zeros((3,3))
-    z = R @ (x[0:2] - p)
-    Dhz = np.array([[z[0], -z[1]], [z[1], z[0]]]) @ n_gain[0:2, 0:2]
-    Dh[0:2, 0:2] = Dhz
-    Dh[2, 2] = n_gain[2, 2]
-    return Dh
+    return _Dhn_o_core(x, p, R, n_gain)
         
 
+# Position of the lidar in the robot's frame
+_LIDAR_VECTOR = np.array([-0.0625, 0])
+_LIDAR_VECTOR.setflags(write=False)
+
+
 class Particle:
     canonical_arrow: np.ndarray = np.array(
         [[0, 0],
@@ -84,23 +170,60 @@ class Particle:
         if map is None:
             # Brand new particle being created: prepare new everything
             self.map = Map()
-            self.pose = np.array(pose)  # np.random.uniform(low=-1, high=1, size=3)
+            self.pose = np.asarray(pose, dtype=np.float64)  # np.random.uniform(low=-1, high=1, size=3)
             self.weight = 1.0
             return
         self.map: Map = map
-        self.pose: np.ndarray = np.array(pose)
+        self.pose: np.ndarray = np.asarray(pose, dtype=np.float64)
         self.weight: float = weight
 
+    # Weights are kept as logs: products of many likelihoods underflow
+    @property
+    def weight(self) -> float:
+        return math.exp(self.log_weight)
+
+    @weight.setter
+    def weight(self, weight: float) -> None:
+        self.log_weight = math.log(weight) if weight > 0 else -math.inf
+
+    @property
+    def pose(self) -> np.ndarray:
+        return self._pose
+
+    @pose.setter
+    def pose(self, pose: np.ndarray) -> None:
+        self._pose = pose
+        self._frame = None
+
+    def _pose_frame(self) -> tuple[np.ndarray, float, np.ndarray]:
+        """Position p, heading theta and rotation R (robot to world frame) of the pose.
+
+        Computed once per pose and shared by every observation made from it, so p and R
+        are read-only. Assign a new pose rather than modifying it in place.
+        """
+        if self._frame is None:
+            px, py, theta = self.pose
+            c, s = math.cos(theta), math.sin(theta)
+            p = np.array([px, py])
+            R = np.array([[c, -s], [s, c]])
+            p.setflags(write=False)
+            R.setflags(write=False)
+            self._frame = p, theta, R
+        return self._frame
+
     def apply_action(self, action: Callable[[np.ndarray], np.ndarray]) -> None:
         self.pose = action(self.pose)
 
-    def make_line_observation(self, obs_data: tuple[int, tuple[float, float]], n_gain: np.ndarray) -> None:
+    def make_line_observation(self, obs_data: tuple[int, tuple[float, float]], n_gain: np.ndarray,
+                              n_cov: np.ndarray = None) -> None:
         """Observe a line on the map. Measurements are in the robot's reference frame.
 
         Args:
             obs_data: A tuple of the form (landmark_id, (rh, th)),
             where rh, th describes a line in the robot's reference frame as 
             (orthogonal distance, angle from robot's heading).
+            n_gain: Gain of the sensor noise.
+            n_cov: n_gain @ n_gain.T, if already known.
 
         Side effects:
             -The map is updated with the observation (a landmark may be added)
@@ -108,21 +231,19 @@ class Particle:
         Returns True if particle's weight was updated
         """
 
-        px, py, theta = self.pose
+        p, theta, R = self._pose_frame()
 
         rh, th = obs_data[1]
-        p = np.array([px, py])
-        R = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-        lidar_vector = np.array([-0.0625, 0])
-        parameters = (p, theta, R, lidar_vector, n_gain)
-
-        observed_landmarks = self.map.landmarks
-        observed_lines_keys = [landmark for landmark in observed_landmarks if landmark < 0]      
-        best_MahDistSqr, best_key = inf, 0
-        for key in observed_lines_keys:
-            MahDistSqr = self.map.landmarks[key].get_Mahalanobis_squared(np.array([rh, th]), diff = diff_t1, parameters = parameters)
-            if MahDistSqr < best_MahDistSqr:
-                best_MahDistSqr, best_key = MahDistSqr, key
+        parameters = LineParameters(p, theta, R, _LIDAR_VECTOR, n_gain)
+
+        lines = self.map.stack(LandmarkType.LINE)
+        observed_lines_keys = lines.ids
+        best_MahDistSqr, best_key = math.inf, 0
+        if observed_lines_keys:
+            # Mahalanobis distance of the observation to every known line at once
+            MahDistSqrs = line_mahalanobis_sqr_batch((rh, th), lines.mus, lines.covs, parameters, n_cov)
+            best_idx = np.argmin(MahDistSqrs)
+            best_MahDistSqr, best_key = MahDistSqrs[best_idx], observed_lines_keys[best_idx]
         landmark_id = best_key
 
         if best_MahDistSqr > 3*3:
@@ -136,10 +257,10 @@ class Particle:
             get_Dhx=get_Dhx_line,
             get_Dhn=get_Dhn_line
         )
-        update_factor = self.map.update(obs, diff = diff_t1, parameters = parameters)
-        if update_factor is None:
+        log_update_factor = self.map.update(obs, diff = diff_t1, parameters = parameters)
+        if log_update_factor is None:
             return False
-        self.weight *= update_factor
+        self.log_weight += log_update_factor
         return True
         
     def make_unoriented_observation(self, obs_data: tuple[int, tuple[float, float]], n_gain: np.ndarray) -> None:
@@ -150,25 +271,23 @@ class Particle:
             -The particle's weight is updated (possibly)
         Returns True if particle's weight was updated
         """
-        px, py, theta = self.pose
+        p, theta, R = self._pose_frame()
         
         r, phi = obs_data[1]
-        p = np.array([px, py])
-        R = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
-        parameters = p, R, n_gain
+        parameters = p, R.T, n_gain
 
         obs = UnorientedObservation(
             landmark_id=obs_data[0]+100,
-            z=np.array([r*np.cos(phi), r*np.sin(phi)]),
+            z=np.array([r*math.cos(phi), r*math.sin(phi)]),
             h=h_uo,
             h_inv=h_inv_uo,
             get_Dhx=get_Dhx_uo,
             get_Dhn=get_Dhn_uo,
         )
-        update_factor = self.map.update(obs, parameters = parameters)
-        if update_factor is None:
+        log_update_factor = self.map.update(obs, parameters = parameters)
+        if log_update_factor is None:
             return False
-        self.weight *= update_factor
+        self.log_weight += log_update_factor
         return True
 
     def make_oriented_observation(self, obs_data: tuple[int, tuple[float, float, float]], n_gain: np.ndarray) -> None:
@@ -178,41 +297,88 @@ class Particle:
             -The map is updated with the observation (a landmark may be added)
             -The particle's weight is updated
         """
-        px, py, theta = self.pose
+        p, theta, R = self._pose_frame()
         
         r, phi, psi = obs_data[1]
-        p = np.array([px, py])
-        R = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
-        parameters = p, theta, R, n_gain
+        parameters = p, theta, R.T, n_gain
 
         obs = Observation(
             landmark_id=obs_data[0],
-            z=np.array([r*np.cos(phi), r*np.sin(phi), psi]),
+            z=np.array([r*math.cos(phi), r*math.sin(phi), psi]),
             h=h_o,
             h_inv=h_inv_o,
             get_Dhx=get_Dhx_o,
             get_Dhn=get_Dhn_o,
         )
-        update_factor = self.map.update(obs,  diff = diff_t2, parameters=parameters)        
-        if update_factor is None:
+        log_update_factor = self.map.update(obs,  diff = diff_t2, parameters=parameters)        
+        if log_update_factor is None:
             return False
-        self.weight *= update_factor
+        self.log_weight += log_update_factor
         return True
 
     def copy(self) -> Particle:
         """Copy the particle, creating a new particle sharing the same map.
         """
-        return Particle(self.map.copy(), copy.copy(self.pose), copy.copy(self.weight))
+        particle = Particle(self.map.copy(), self.pose.copy())
+        particle.log_weight = self.log_weight
+        return particle
 
     def _draw(self, line: plt.Line2D) -> None:
-        R = np.array([[np.cos(self.pose[2]), -np.sin(self.pose[2])],
-                      [np.sin(self.pose[2]), np.cos(self.pose[2])]])
+        p, theta, R = self._pose_frame()
         arrow = (R @ self.canonical_arrow.T)
-        arrow = (arrow.T + self.pose[:2]).T
+        arrow = (arrow.T + p).T
         line.set_data(arrow[0, :], arrow[1, :])
 
     def __repr__(self) -> str:
-        return f'Particle(pose={self.pose}, weight={self.weight})'
+        return f'Particle(pose={self.pose}, log_weight={self.log_weight})'
 
     def __str__(self) -> str:
         return self.__repr__()
+
+
+def draw_particles(particles: list[Particle], lines: list[plt.Line2D]) -> None:
+    """Same as particles[i]._draw(lines[i]) for every i, with all arrows transformed at once."""
+    poses = np.array([particle.pose for particle in particles], dtype=float)
+    c, s = np.cos(poses[:, 2:3]), np.sin(poses[:, 2:3])
+    ax, ay = Particle.canonical_arrow[:, 0], Particle.canonical_arrow[:, 1]
+    # (N, 6) coordinates of every arrow vertex, R @ arrow + p for each particle
+    xs = c*ax - s*ay + poses[:, 0:1]
+    ys = s*ax + c*ay + poses[:, 1:2]
+    for line, x, y in zip(lines, xs, ys):
+        line.set_data(x, y)
+
+
+def make_oriented_observation_batch(particles: list[Particle], obs_data: tuple[int, tuple[float, float, float]],
+                                    n_gain: np.ndarray) -> np.ndarray:
+    """Same as particles[i].make_oriented_observation(obs_data, n_gain) for every i.
+
+    The particles whose maps already have the landmark are updated with one kernel call;
+    the others create it through the per particle path.
+    Returns a boolean array, True where the particle's weight was updated.
+    """
+    landmark_id = obs_data[0]
+    changed_mask = np.zeros((len(particles),), dtype=bool)
+    known = []
+    for i, particle in enumerate(particles):
+        if landmark_id in particle.map.landmarks:
+            known.append(i)
+        else:
+            changed_mask[i] = particle.make_oriented_observation(obs_data, n_gain)
+    if not known:
+        return changed_mask
+
+    r, phi, psi = obs_data[1]
+    z = np.array([r*math.cos(phi), r*math.sin(phi), psi])
+    landmarks = [particles[i].map.landmarks[landmark_id] for i in known]
+    poses = np.array([particles[i].pose for i in known], dtype=np.float64)
+    mus = np.array([landmark.get_mu() for landmark in landmarks], dtype=np.float64)
+    covs = np.array([landmark.get_cov() for landmark in landmarks], dtype=np.float64)
+    mus, covs, zxs, log_likelihoods = _oriented_update_batch_core(z, poses, mus, covs, np.asarray(n_gain, dtype=np.float64))
+    # Same floor as EKF.get_log_likelihood
+    log_likelihoods[log_likelihoods < _LOG_PDF_UNDERFLOW] = _LOG_PDF_FLOOR
+    for j, i in enumerate(known):
+        particle = particles[i]
+        particle.map.set_landmark_state(LandmarkType.ORIENTED, landmark_id, mus[j], covs[j], zxs[j])
+        particle.log_weight += log_likelihoods[j]
+    changed_mask[known] = True
+    return changed_mask
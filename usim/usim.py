@@ -167,8 +167,9 @@ if __name__=="__main__":
 
     files = os.listdir(sd.DEFAULT_SENSOR_DATA_DIR)
     num=0
-    format = lambda num: f'sim{num}.xz'
-    while format(num) in files:
+    # Named after the compression it is written with; numbers are not reused across extensions
+    format = lambda num, ext=sd.DEFAULT_COMPRESSION: f'sim{num}.{ext}'
+    while any(format(num, ext) in files for ext in ('xz', 'lz4')):
         num+=1
     sd.save_sensor_data(sensor_data_object, format(num))
 